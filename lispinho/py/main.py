@@ -5,10 +5,12 @@
 from __future__ import print_function
 from pprint import pprint
 
+import array
 import enum
 import os
 import readline
 import sys
+import tempfile
 
 # Python 2 portability
 try: input = raw_input
@@ -59,46 +61,117 @@ class Atom:
                 other.name == self.name)
 
 
+class Env:
+    """Scope of a single call that falls back to the one it was created in
+
+    Compiled code reads and writes the values by their position, the
+    names are only used by lookups coming from primitives and macros.
+    The names are shared by all the calls of a lambda, so names that
+    primitives and macros define without a slot go in `defined', a
+    dictionary of the call.  The outermost scope is a plain dictionary,
+    usually a copy of `primFuncs', so global definitions aren't copied
+    on each call.
+    """
+    def __init__(self, names, values, parent):
+        self.names = names
+        self.values = values
+        self.parent = parent
+        self.defined = None
+    def __repr__(self):
+        scope = {name: value for name, value in zip(self.names, self.values)
+                 if value is not unset}
+        scope.update(self.defined or {})
+        return "Env({})".format(repr(scope))
+    def __getitem__(self, name):
+        env = self
+        while isinstance(env, Env):
+            if name in env.names:
+                # Names defined with `label' have no value until it runs
+                index = env.names.index(name)
+                if index < len(env.values) and env.values[index] is not unset:
+                    return env.values[index]
+            if env.defined and name in env.defined: return env.defined[name]
+            env = env.parent
+        return env[name]
+    def __setitem__(self, name, value):
+        if name in self.names:
+            setSlot(self.values, self.names.index(name), value)
+        else:
+            if self.defined is None: self.defined = {}
+            self.defined[name] = value
+    def __contains__(self, name):
+        try: self[name]
+        except KeyError: return False
+        return True
+
+
+# Value of the slots of names whose `label' didn't run yet
+unset = object()
+
+
+def setSlot(values, index, value):
+    if index >= len(values): values.extend([unset] * (index + 1 - len(values)))
+    values[index] = value
+
+
 class Lambda:
-    def __init__(self, arglist, body):
+    def __init__(self, arglist, body, env=None, code=None, names=None, arity=0):
         self.arglist = arglist
         self.body = body
-    def callBody(self, argEnv):
-        if isinstance(self.body, Nil): return nil
-        return car(_flattenCons(self.body, argEnv))
+        # Scope the lambda was created in
+        self.env = env
+        # The body compiled by `compileBody()' and the names of the
+        # slots of its scope, arguments first.  Lambdas created by
+        # compiled code get them right away, others on their first call
+        self.code = code
+        self.names = names
+        self.arity = arity
+        # The body assembled by `assembleLambda()' for the VM
+        self.bytecode = None
     def __str__(self):
         printobj(self.arglist, end='\n')
         printobj(self.body, end='\n')
         print()
         return repr(self)
+    def compile(self):
+        names = [atom.name for atom in consList(self.arglist)]
+        self.arity = len(names)
+        self.code = compileBody(self.body, True, (names,))
+        self.names = names
+    def apply(self, values):
+        # Calls in tail position return a `TailCall' instead of
+        # calling the lambda, and it's run here in a loop.  Recursion
+        # in tail position doesn't grow the Python stack.
+        fn = self
+        while True:
+            if fn.code is None: fn.compile()
+            if fn.arity != len(values): raise TypeError('wrong arity')
+            value = fn.code(Env(fn.names, values, fn.env))
+            if not isinstance(value, TailCall): return value
+            fn, values = value.fn, value.values
     def __call__(self, args, env):
-        argEnv = env.copy()
-        # No parameters, let's bail
-        if isinstance(self.arglist, Nil):
-            return self.callBody(argEnv)
-        assert(len(self.arglist) == len(args))
-        i, head, tail = 0, car(self.arglist), cdr(self.arglist)
-        flattenArgs = _flattenCons(args, env)
-        while head != nil:
-            assert(isinstance(head, Atom))
-            argEnv[head.name] = flattenArgs[i]
-            i += 1
-            if tail == nil: break
-            head, tail = car(tail), cdr(tail)
-        return self.callBody(argEnv)
+        return self.apply(_flattenCons(args, env))
+
+
+class TailCall:
+    def __init__(self, fn, values):
+        self.fn = fn
+        self.values = values
 
 
 class Macro:
     def __init__(self, arglist, body):
         self.arglist = arglist
         self.body = body
-    def callBody(self, argEnv):
-        return evalValue(qqEval(self.body, argEnv.copy()), argEnv)
+    def callBody(self, argEnv, env):
+        # The expansion sees the arguments but runs where the macro
+        # was called
+        return evalValue(qqEval(self.body, argEnv), env)
     def __call__(self, args, env):
-        argEnv = env
+        argEnv = Env([], [], env)
         # No parameters, let's bail
         if isinstance(self.arglist, Nil):
-            return self.callBody(argEnv)
+            return self.callBody(argEnv, env)
         assert(len(self.arglist) == len(args))
         i, head, tail = 0, car(self.arglist), cdr(self.arglist)
         ahead, atail = car(args), cdr(args)
@@ -111,7 +184,7 @@ class Macro:
             if atail == nil: raise TypeError('wrong arity')
             head, tail = car(tail), cdr(tail)
             ahead, atail = car(atail), cdr(atail)
-        return self.callBody(argEnv)
+        return self.callBody(argEnv, env)
 
 
 class Nil:
@@ -199,18 +272,19 @@ class Parser:
         return value
 
     def parseCons(self):
-        if self.matchToken(TokenType.CLOSE_PAR): return None
-        a = self.parseValue()
-        if a is None: return None
-
-        if self.matchToken(TokenType.DOT):
-            b = self.parseValue()
-            if b: return [a, b]
-            else: return [a, nil]
-
-        b = self.parseCons()
-        if b is not None: return [a, b]
-        else: return [a, nil]
+        # The elements are read in a loop so long lists don't recurse
+        items, last = [], nil
+        while not self.matchToken(TokenType.CLOSE_PAR):
+            a = self.parseValue()
+            if a is None: break
+            items.append(a)
+            if self.matchToken(TokenType.DOT):
+                b = self.parseValue()
+                if b: last = b
+                self.matchToken(TokenType.CLOSE_PAR)
+                break
+        for item in reversed(items): last = [item, last]
+        return last
 
     def parseValue(self):
         if self.matchToken(TokenType.OPEN_PAR):
@@ -252,13 +326,18 @@ def caar(l): return car(l[0])
 def cdr(l): return l[1]
 
 
-def _flattenCons(v, env):
-    if isinstance(v, Nil): return []
-    out = [evalValue(car(v), env)]
-    out.extend(_flattenCons(cdr(v), env))
+def consList(v):
+    out = []
+    while not isinstance(v, Nil):
+        out.append(car(v))
+        v = cdr(v)
     return out
 
 
+def _flattenCons(v, env):
+    return [evalValue(a, env) for a in consList(v)]
+
+
 def primEnv(args, env):
     return env
 
@@ -274,13 +353,16 @@ def primSum(args, env):
 
 
 def primRequire(args, env):
-    newEnv = primFuncs.copy()
     fileName = car(args)
-    evalFile(fileName, newEnv)
-    for i in primFuncs: del newEnv[i]
     baseName, _ = os.path.splitext(fileName)
     if baseName in primFuncs: raise ImportError('Name {} is reserved'.format(baseName))
-    env[baseName] = newEnv
+    # The lambdas of the file keep its scope, primitives and all, so
+    # only the names it defined are exported instead of the
+    # primitives being taken out of it
+    newEnv = primFuncs.copy()
+    evalFile(fileName, newEnv)
+    env[baseName] = {name: value for name, value in newEnv.items()
+                     if primFuncs.get(name) is not value}
     return nil
 
 
@@ -360,8 +442,8 @@ def primProgn(args, env):
 
 
 def primLambda(args, env):
-    if isinstance(args, Nil): return Lambda(nil, nil)
-    return Lambda(car(args), cdr(args))
+    if isinstance(args, Nil): return Lambda(nil, nil, env)
+    return Lambda(car(args), cdr(args), env)
 
 
 def primMacro(args, env):
@@ -419,13 +501,415 @@ primFuncs = {
 }
 
 
-def evaluate(code, env):
+# Special forms and a few primitives are also compiled into closures
+# that take the environment, so each form is analyzed once instead of
+# every time it runs.  Other callables still get their arguments
+# unevaluated.  Forms compiled with `tail' set are the last thing a
+# lambda body does.
+#
+# `scopes' holds the names of the lambdas the form is in, innermost
+# last.  References to them are resolved to the depth of the scope and
+# the position of the name in it.  Other names are looked up by name
+# from the innermost call, since macros and primitives can define them
+# there, and usually end up in the globals.
+
+Constant = lambda value: lambda env: value
+
+
+def Local(depth, index, name):
+    # Until the `label' of a name runs, the name is looked up by name
+    # from the scope of its slot
+    if depth == 0:
+        def local(env):
+            values = env.values
+            if index < len(values) and values[index] is not unset: return values[index]
+            return lookup(env, name)
+        return local
+    def local(env):
+        for _ in range(depth): env = env.parent
+        values = env.values
+        if index < len(values) and values[index] is not unset: return values[index]
+        return lookup(env, name)
+    return local
+
+
+def Global(name):
+    # Macros and primitives can define names in any of the calls the
+    # form is in, so the lookup starts at the innermost one
+    return lambda env: lookup(env, name)
+
+
+def Label(name, code):
+    def label(env):
+        value = env[name] = code(env)
+        return value
+    return label
+
+
+def LocalLabel(index, code):
+    def label(env):
+        value = code(env)
+        setSlot(env.values, index, value)
+        return value
+    return label
+
+
+def Cond(clauses):
+    def cond(env):
+        for test, code in clauses:
+            if test(env) is not nil: return code(env)
+        return nil
+    return cond
+
+
+def Progn(codes):
+    def progn(env):
+        for code in codes: value = code(env)
+        return value
+    return progn
+
+
+def MakeLambda(arglist, body, code, names, arity):
+    return lambda env: Lambda(arglist, body, env, code, names, arity)
+
+
+def Call(fn, args, tail, scopes):
+    # Macros and most primitives take their arguments unevaluated, so
+    # they're only compiled the first time a lambda is called here
+    argCodes = []
+    def call(env):
+        f = fn(env)
+        if isinstance(f, Lambda):
+            if not argCodes: argCodes.append([compileValue(a, False, scopes) for a in consList(args)])
+            values = [code(env) for code in argCodes[0]]
+            if tail: return TailCall(f, values)
+            return f.apply(values)
+        assert(callable(f))
+        strict = strictPrims.get(f)
+        if strict is not None:
+            if not argCodes: argCodes.append([compileValue(a, False, scopes) for a in consList(args)])
+            return strict([code(env) for code in argCodes[0]])
+        return f(args, env)
+    return call
+
+
+def resolve(name, scopes):
+    for depth, names in enumerate(reversed(scopes)):
+        if name in names: return depth, names.index(name)
+    return len(scopes), None
+
+
+def compileAtom(atom, scopes):
+    depth, index = resolve(atom.name, scopes)
+    if index is None: return Global(atom.name)
+    return Local(depth, index, atom.name)
+
+
+def compileQuote(args, tail, scopes): return Constant(car(args))
+
+
+def compileCond(args, tail, scopes):
+    return Cond([(compileValue(car(clause), False, scopes),
+                  compileValue(car(cdr(clause)), tail, scopes))
+                 for clause in consList(args)])
+
+
+def compileLabel(args, tail, scopes):
+    assert(isinstance(car(args), Atom))
+    name, code = car(args).name, compileValue(car(cdr(args)), False, scopes)
+    if not scopes: return Label(name, code)
+    # Names defined within a lambda get a slot in its scope.  The
+    # arguments of a call may be compiled after the lambda, so the
+    # slot is added to the frame when the label runs.
+    names = scopes[-1]
+    if name not in names: names.append(name)
+    return LocalLabel(names.index(name), code)
+
+
+def compileLambda(args, tail, scopes):
+    if isinstance(args, Nil): return MakeLambda(nil, nil, Constant(nil), [], 0)
+    names = [atom.name for atom in consList(car(args))]
+    arity = len(names)
+    code = compileBody(cdr(args), True, scopes + (names,))
+    return MakeLambda(car(args), cdr(args), code, names, arity)
+
+
+def compileBody(body, tail=False, scopes=()):
+    forms = consList(body)
+    if not forms: return Constant(nil)
+    codes = [compileValue(v, False, scopes) for v in forms[:-1]]
+    codes.append(compileValue(forms[-1], tail, scopes))
+    if len(codes) == 1: return codes[0]
+    return Progn(codes)
+
+
+def compileCons(v, tail, scopes):
+    head, args = car(v), cdr(v)
+    if isinstance(head, Atom) and head.name in specialForms:
+        return specialForms[head.name](args, tail, scopes)
+    return Call(compileValue(head, False, scopes), args, tail, scopes)
+
+
+def compileValue(v, tail=False, scopes=()):
+    if isinstance(v, (int, float, str)): return Constant(v)
+    elif isinstance(v, Atom): return compileAtom(v, scopes)
+    elif isinstance(v, list): return compileCons(v, tail, scopes)
+    elif isinstance(v, Nil): return Constant(nil)
+
+
+specialForms = {
+    'quote': compileQuote,
+    'cond': compileCond,
+    'label': compileLabel,
+    'lambda': compileLambda,
+    'progn': compileBody,
+}
+
+
+# Primitives that can take their arguments already evaluated
+strictPrims = {
+    primSum: sum,
+    primCar: lambda values: car(values[0]),
+    primCdr: lambda values: cdr(values[0]),
+}
+
+
+# The VM runs forms assembled into bytecode.  Each instruction is an
+# opcode followed by its argument in an array of integers, anything
+# else it needs goes in the constants of the `Code'.  Lambdas are called
+# within the same loop as the code that calls them, with the caller
+# saved in a list of frames, so no call grows the Python stack.
+#
+# A call pushes the callee and runs ARGS, which decides how the
+# arguments are passed once the callee is known, like `Call' does.
+# Callees that take their arguments unevaluated get the raw arguments
+# and the call is skipped.  For lambdas and strict primitives ARGS
+# jumps to the code that pushes the arguments and jumps back to CALL.
+# That code is assembled at the end of the `Code' the first time, since
+# the arguments of macros aren't always code.
+
+(OP_CONST,
+ OP_LOCAL,
+ OP_FREE,
+ OP_GLOBAL,
+ OP_SET_LOCAL,
+ OP_SET_NAME,
+ OP_POP,
+ OP_JUMP,
+ OP_JUMP_IF_NIL,
+ OP_LAMBDA,
+ OP_ARGS,
+ OP_CALL,
+ OP_TAIL_CALL,
+ OP_RETURN,
+) = range(14)
+
+
+class Code:
+    def __init__(self, names=None, arity=0):
+        self.instructions = array.array('l')
+        self.constants = []
+        # Names of the slots of the scope, arguments first
+        self.names = names if names is not None else []
+        self.arity = arity
+    def emit(self, op, arg=0):
+        self.instructions.extend((op, arg))
+        return len(self.instructions) - 2
+    def patch(self, address, arg):
+        self.instructions[address + 1] = arg
+    def here(self):
+        return len(self.instructions)
+    def constant(self, value):
+        self.constants.append(value)
+        return len(self.constants) - 1
+
+
+def assembleAtom(code, atom, scopes):
+    depth, index = resolve(atom.name, scopes)
+    if index is None: code.emit(OP_GLOBAL, code.constant(atom.name))
+    elif depth == 0: code.emit(OP_LOCAL, index)
+    else:
+        assert(index < 1 << 16)
+        code.emit(OP_FREE, depth << 16 | index)
+
+
+def assembleQuote(code, args, tail, scopes):
+    code.emit(OP_CONST, code.constant(car(args)))
+
+
+def assembleCond(code, args, tail, scopes):
+    jumps = []
+    for clause in consList(args):
+        assembleValue(code, car(clause), False, scopes)
+        skip = code.emit(OP_JUMP_IF_NIL)
+        assembleValue(code, car(cdr(clause)), tail, scopes)
+        jumps.append(code.emit(OP_JUMP))
+        code.patch(skip, code.here())
+    code.emit(OP_CONST, code.constant(nil))
+    for jump in jumps: code.patch(jump, code.here())
+
+
+def assembleLabel(code, args, tail, scopes):
+    if not isinstance(car(args), Atom): raise SyntaxError('Label expects an atom')
+    name = car(args).name
+    assembleValue(code, car(cdr(args)), False, scopes)
+    if not scopes:
+        code.emit(OP_SET_NAME, code.constant(name))
+        return
+    names = scopes[-1]
+    if name not in names: names.append(name)
+    code.emit(OP_SET_LOCAL, names.index(name))
+
+
+def assembleLambda(arglist, body, scopes=()):
+    names = [atom.name for atom in consList(arglist)]
+    code = Code(names, len(names))
+    assembleBody(code, body, True, scopes + (names,))
+    code.emit(OP_RETURN)
+    return code
+
+
+def assembleMakeLambda(code, args, tail, scopes):
+    arglist, body = (nil, nil) if isinstance(args, Nil) else (car(args), cdr(args))
+    lambdaCode = assembleLambda(arglist, body, scopes)
+    code.emit(OP_LAMBDA, code.constant((arglist, body, lambdaCode)))
+
+
+def assembleBody(code, body, tail=False, scopes=()):
+    forms = consList(body)
+    if not forms: code.emit(OP_CONST, code.constant(nil))
+    for i, v in enumerate(forms):
+        if i: code.emit(OP_POP)
+        assembleValue(code, v, tail and i == len(forms) - 1, scopes)
+
+
+def assembleCall(code, fn, args, tail, scopes):
+    assembleValue(code, fn, False, scopes)
+    # The raw arguments, the scopes to assemble them in, the address of
+    # the call and the one of the assembled arguments once there's one
+    call = [args, scopes, None, None]
+    code.emit(OP_ARGS, code.constant(call))
+    call[2] = code.emit(OP_TAIL_CALL if tail else OP_CALL)
+
+
+def assembleArgs(code, call):
+    args, scopes, address, _ = call
+    call[3] = code.here()
+    values = consList(args)
+    for v in values: assembleValue(code, v, False, scopes)
+    code.emit(OP_JUMP, address)
+    code.patch(address, len(values))
+
+
+def assembleCons(code, v, tail, scopes):
+    head, args = car(v), cdr(v)
+    if isinstance(head, Atom) and head.name in assemblers:
+        return assemblers[head.name](code, args, tail, scopes)
+    assembleCall(code, head, args, tail, scopes)
+
+
+def assembleValue(code, v, tail=False, scopes=()):
+    if isinstance(v, Atom): assembleAtom(code, v, scopes)
+    elif isinstance(v, list): assembleCons(code, v, tail, scopes)
+    else: code.emit(OP_CONST, code.constant(v))
+
+
+assemblers = {
+    'quote': assembleQuote,
+    'cond': assembleCond,
+    'label': assembleLabel,
+    'lambda': assembleMakeLambda,
+    'progn': assembleBody,
+}
+
+
+def assemble(v):
+    code = Code()
+    assembleValue(code, v)
+    code.emit(OP_RETURN)
+    return code
+
+
+def execute(code, env):
+    instructions, constants = code.instructions, code.constants
+    values = env.values if isinstance(env, Env) else None
+    stack, frames, pc = [], [], 0
+    # The most common instructions are tested first
+    while True:
+        op = instructions[pc]
+        arg = instructions[pc + 1]
+        pc += 2
+        if op == OP_LOCAL:
+            if arg < len(values) and values[arg] is not unset: stack.append(values[arg])
+            else: stack.append(lookup(env, env.names[arg]))
+        elif op == OP_GLOBAL:
+            stack.append(lookup(env, constants[arg]))
+        elif op == OP_ARGS:
+            f, call = stack[-1], constants[arg]
+            if isinstance(f, Lambda) or f in strictPrims:
+                if call[3] is None: assembleArgs(code, call)
+                pc = call[3]
+            else:
+                assert(callable(f))
+                stack[-1] = f(call[0], env)
+                pc = call[2] + 2
+        elif op == OP_CALL or op == OP_TAIL_CALL:
+            if arg:
+                args = stack[-arg:]
+                del stack[-arg:]
+            else:
+                args = []
+            f = stack.pop()
+            if not isinstance(f, Lambda):
+                stack.append(strictPrims[f](args))
+                continue
+            if f.bytecode is None: f.bytecode = assembleLambda(f.arglist, f.body)
+            fcode = f.bytecode
+            if fcode.arity != arg: raise TypeError('wrong arity')
+            if op == OP_CALL: frames.append((code, pc, env, values))
+            code, pc = fcode, 0
+            instructions, constants = code.instructions, code.constants
+            env, values = Env(fcode.names, args, f.env), args
+        elif op == OP_CONST:
+            stack.append(constants[arg])
+        elif op == OP_JUMP_IF_NIL:
+            if stack.pop() is nil: pc = arg
+        elif op == OP_RETURN:
+            if not frames: return stack.pop()
+            code, pc, env, values = frames.pop()
+            instructions, constants = code.instructions, code.constants
+        elif op == OP_JUMP:
+            pc = arg
+        elif op == OP_POP:
+            stack.pop()
+        elif op == OP_FREE:
+            scope, index = env, arg & 0xffff
+            for _ in range(arg >> 16): scope = scope.parent
+            if index < len(scope.values) and scope.values[index] is not unset:
+                stack.append(scope.values[index])
+            else:
+                stack.append(lookup(scope, scope.names[index]))
+        elif op == OP_SET_LOCAL:
+            setSlot(values, arg, stack[-1])
+        elif op == OP_SET_NAME:
+            env[constants[arg]] = stack[-1]
+        elif op == OP_LAMBDA:
+            arglist, body, fcode = constants[arg]
+            f = Lambda(arglist, body, env)
+            f.bytecode = fcode
+            stack.append(f)
+        else:
+            raise Exception('Unknown instruction {}'.format(op))
+
+
+def evaluate(code, env, vm=False):
     parser = Parser(code)
     lastValue = None
     while True:
         expr = parser.parse()
         if expr is None: break
-        lastValue = evalValue(expr, env)
+        if vm: lastValue = execute(assemble(expr), env)
+        else: lastValue = compileValue(expr)(env)
     return lastValue
 
 
@@ -448,7 +932,7 @@ def printobj(obj, end=''):
     else: print(obj, end=end)
 
 
-def repl():
+def repl(vm=False):
     env = primFuncs
     env.update({'exit': lambda args, env: exit()})
     print('lispinho {}'.format(__version__))
@@ -456,18 +940,21 @@ def repl():
     while True:
         userInput = input("> ")
         if not userInput: continue
-        value = evaluate(userInput, env)
+        value = evaluate(userInput, env, vm)
         if value is not None: printobj(value)
         print()
 
 
-def evalFile(fileName, env=primFuncs):
-    return evaluate(open(fileName).read(), env)
+def evalFile(fileName, env=primFuncs, vm=False):
+    return evaluate(open(fileName).read(), env, vm)
 
 
 def main(args=sys.argv[1:]):
-    if args: return evalFile(args[0])
-    try: repl()
+    # `--vm' runs the code on the bytecode VM instead of the closures
+    vm = '--vm' in args
+    args = [arg for arg in args if arg != '--vm']
+    if args: return evalFile(args[0], vm=vm)
+    try: repl(vm)
     except EOFError: print()
 
 
@@ -609,6 +1096,12 @@ def test_parser():
     # pprint(run("'test"))
     assert(run("'test")                      == [Atom('quote'), [Atom('test'), nil]])
 
+    # pprint(run('(a . b)'))
+    assert(run('((a . b) c)')                == [[Atom('a'), Atom('b')], [Atom('c'), nil]])
+
+    # pprint(run('()'))
+    assert(run('()')                         == nil)
+
     # pprint(run('(1.2 3.4)'))
     assert(run('(1.2 3.4)')                  == [1.2, [3.4, nil]])
 
@@ -732,12 +1225,217 @@ def test_macros():
     # run("(label x (macro (a) `(,@a)))")
     # assert(run("(x '1)") == 1)
 
+def test_environments():
+    localEnv = primFuncs.copy()
+    run = lambda c: evaluate(c, localEnv)
+
+    # Calls only hold their own arguments
+    run("(label scope (lambda (x y) (env)))")
+    scope = run("(scope 1 2)")
+    assert(scope.names == ['x', 'y'] and scope.values == [1, 2])
+    assert(run("(label foo 1)") == 1)
+    assert(localEnv['foo'] == 1)
+
+    # Lambdas see the scope they were created in
+    run("(label adder (lambda (n) (lambda (x) (+ x n))))")
+    run("(label add2 (adder 2))")
+    assert(run("(add2 3)") == 5)
+    assert(run("((lambda (x) ((lambda (y) (+ x y)) 2)) 1)") == 3)
+
+    # Names defined in a call stay in the call
+    assert(run("((lambda (x) (progn (label bar x) bar)) 4)") == 4)
+    assert('bar' not in localEnv)
+
+    # Lambdas of required files still see the primitives
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = os.path.join(directory, 'lib.lisp')
+        with open(fileName, 'w') as f: f.write("(label inc (lambda (x) (+ x 1)))")
+        primRequire([fileName, nil], localEnv)
+        lib = localEnv[os.path.splitext(fileName)[0]]
+        assert(list(lib) == ['inc'])
+        assert(lib['inc'].apply([1]) == 2)
+
+
+def test_compiler():
+    # Compiled code doesn't depend on the environment it runs in
+    code = compileValue(parse("(+ x 1)"))
+    assert(code(Env(['x'], [1], primFuncs)) == 2)
+    assert(code(Env(['x'], [41], primFuncs)) == 42)
+
+    # Special forms don't need to be defined
+    assert(compileValue(parse("(quote a)"))({}) == Atom('a'))
+    assert(compileValue(parse("(cond (nil 1) (2 3))"))({'nil': nil}) == 3)
+
+    localEnv = primFuncs.copy()
+    run = lambda c: evaluate(c, localEnv)
+
+    # Lambda bodies are compiled once, with the last form as the value
+    run("(label f (lambda (x) (label y 1) (+ x y)))")
+    code = localEnv['f'].code
+    assert(run("(f 1)") == 2)
+    assert(run("(f 2)") == 3)
+    assert(localEnv['f'].code is code)
+
+    # Lambdas called by primitives that evaluate their arguments
+    assert(run("(car (cons (f 1) nil))") == 2)
+    assert(run("(cdr (cons 1 ((lambda (x) x) 2)))") == 2)
+
+
+def test_tail_calls():
+    localEnv = primFuncs.copy()
+    run = lambda c: evaluate(c, localEnv)
+
+    size = sys.getrecursionlimit() * 2
+    run("(label numbers '(" + " ".join(str(i) for i in range(size)) + "))")
+    run("(label walk (lambda (l acc)"
+        "  (cond ((cdr l) (walk (cdr l) (+ acc (car l))))"
+        "        (1 (+ acc (car l))))))")
+    assert(run("(walk numbers 0)") == sum(range(size)))
+
+    # Mutual recursion through progn
+    run("(label even (lambda (l) (cond ((cdr l) (progn 1 (odd (cdr l)))) (1 'odd))))")
+    run("(label odd (lambda (l) (cond ((cdr l) (even (cdr l))) (1 'even))))")
+    assert(run("(even numbers)") == Atom('even'))
+
+    # Called from a primitive that evaluates its arguments
+    assert(run("(cons (walk numbers 0) nil)") == [sum(range(size)), nil])
+
+
+def test_lexical_addressing():
+    localEnv = primFuncs.copy()
+    run = lambda c: evaluate(c, localEnv)
+
+    assert(resolve('x', ()) == (0, None))
+    assert(resolve('x', (['x', 'y'], ['z'])) == (1, 0))
+    assert(resolve('z', (['x', 'y'], ['z'])) == (0, 0))
+    assert(resolve('y', (['y'], ['x', 'y'])) == (0, 1))
+
+    # Inner arguments shadow the outer ones
+    assert(run("((lambda (x y) ((lambda (x) (+ x y)) 10)) 1 2)") == 12)
+    assert(run("((lambda (x) ((lambda (y) ((lambda (z) (+ x y z)) 3)) 2)) 1)") == 6)
+
+    # Names defined with label get a slot of their own
+    run("(label f (lambda (x) (label y (+ x 1)) (label x y) (env)))")
+    scope = run("(f 1)")
+    assert(scope.names == ['x', 'y'] and scope.values == [2, 2])
+    assert('y' not in localEnv)
+
+    # Even when it's compiled after the lambda
+    run("(label h (lambda (x) ((lambda (a b) (cons a b)) (label z (+ x 1)) z)))")
+    assert(run("(h 1)") == [2, 2])
+    assert(run("(h 2)") == [3, 3])
+    assert(localEnv['h'].names == ['x', 'z'])
+
+    # Names defined by macros don't share the slots of labels that are
+    # compiled later, and they can be read from the lambda
+    run("(label deflocal (macro (n v) `(label ,n ,v)))")
+    scope = run("((lambda (x) (deflocal a 7) ((lambda (p q) q) (label b 5) (env))) 1)")
+    assert((scope['x'], scope['a'], scope['b']) == (1, 7, 5))
+    assert(run("((lambda (x) (deflocal a 7) a) 1)") == 7)
+    assert(run("((lambda (x) ((lambda (y) (deflocal a y) a) x)) 3)") == 3)
+    assert(run("((lambda (x) (deflocal a 7) ((lambda (y) a) 1)) 1)") == 7)
+
+    # Until its label runs, the name is looked up around the lambda
+    run("(label y 1)")
+    assert(run("((lambda (x) (cond (x (label y 2))) y) nil)") == 1)
+    assert(run("((lambda (x) (cond (x (label y 2))) y) 1)") == 2)
+    assert(run("((lambda (x) (cond (x (label y 2))) ((lambda () y))) nil)") == 1)
+    assert(run("((lambda (x) (cond (x (label y 2))) (env)) nil)")['y'] == 1)
+    try: run("((lambda (x) (cond (x (label unknown 2))) unknown) nil)")
+    except NameError: pass
+    else: assert(False)
+
+    # Globals are looked up when the lambda runs
+    run("(label g (lambda (x) (+ x later)))")
+    run("(label later 5)")
+    assert(run("(g 1)") == 6)
+    run("(label missing (lambda (x) (+ x nothing)))")
+    try: run("(missing 1)")
+    except NameError: pass
+    else: assert(False)
+
+    # Primitives and macros see the arguments by their names
+    run("(label twice (macro (x) `(+ ,x ,x)))")
+    assert(run("((lambda (a) (twice a)) 4)") == 8)
+    assert(run("((lambda (a) (cons a (cons (quote b) nil))) 1)") == [1, [Atom('b'), nil]])
+
+
+def test_vm():
+    code = assemble(parse("(+ 1 2)"))
+    assert(code.instructions.typecode == 'l')
+    assert(list(code.instructions[:4]) == [OP_GLOBAL, 0, OP_ARGS, 1])
+    assert(code.constants[0] == '+')
+    assert(execute(code, primFuncs.copy()) == 3)
+
+    # Same results as the closures
+    programs = [
+        "1", '"test"', "'an-atom", "(+ 1.2 3.4)", "(car '(1 2 3))", "(cdr '(1 2 3))",
+        "(cond (nil 1) (nil 2) (1 3))", "(cond (nil 1))", "(cons 1 (cons 2 nil))",
+        "((lambda (x) (+ x 1)) 2)", "((lambda ()))", "`(0 ,(+ 1 2) 6)", "`(a ,@'(1 2) c)",
+        "(progn (label foo (lambda (x y) (+ x y))) (foo 2 3))",
+        "(progn (label m (macro (x) `(+ 1 ,x))) (m 2))",
+        "(progn (label adder (lambda (n) (lambda (x) (+ x n)))) ((adder 2) 3))",
+        "((lambda (x y) ((lambda (x) (+ x y)) 10)) 1 2)",
+        "((lambda (x) ((lambda (y) ((lambda (z) (+ x y z)) 3)) 2)) 1)",
+        "((lambda (x) (label y (+ x 1)) (label x y) (+ x y)) 1)",
+        "((lambda (a) (cons a (cons (quote b) nil))) 1)",
+        "(progn (label twice (macro (x) `(+ ,x ,x))) ((lambda (a) (twice a)) 4))",
+        "(progn (label y 1) ((lambda (x) (cond (x (label y 2))) y) nil))",
+        "(progn (label deflocal (macro (n v) `(label ,n ,v)))"
+        " ((lambda (x) (deflocal a 7) ((lambda (p q) q) (label b 5) (cons a (cons b nil)))) 1))",
+        "(progn (label deflocal (macro (n v) `(label ,n ,v))) ((lambda (x) (deflocal a 7) a) 1))",
+        "(progn (label y 1) ((lambda (x) (cond (x (label y 2))) ((lambda () y))) nil))",
+        "(progn (label y 1) ((lambda (x) (cond (x (label y 2))) y) 1))",
+    ]
+    for program in programs:
+        expected = evaluate(program, primFuncs.copy())
+        assert(evaluate(program, primFuncs.copy(), vm=True) == expected), program
+
+    localEnv = primFuncs.copy()
+    run = lambda c: evaluate(c, localEnv, vm=True)
+
+    size = sys.getrecursionlimit() * 2
+    run("(label numbers '(" + " ".join(str(i) for i in range(size)) + "))")
+    run("(label walk (lambda (l acc)"
+        "  (cond ((cdr l) (walk (cdr l) (+ acc (car l))))"
+        "        (1 (+ acc (car l))))))")
+    assert(run("(walk numbers 0)") == sum(range(size)))
+
+    # Calls that aren't in tail position don't use the Python stack either
+    run("(label total (lambda (l)"
+        "  (cond ((cdr l) (+ (car l) (total (cdr l))))"
+        "        (1 (car l)))))")
+    assert(run("(total numbers)") == sum(range(size)))
+
+    # Arguments are assembled the first time a lambda is called with
+    # them, the arguments of macros aren't always code
+    run("(label quoted (macro (x) `(quote ,x)))")
+    assert(run("(car (quoted (label (a) 1)))") == Atom('label'))
+    run("(label apply1 (lambda (f) (f (label z 2))))")
+    assert(run("(apply1 quoted)") == [Atom('label'), [Atom('z'), [2, nil]]])
+    assert(localEnv['apply1'].bytecode.names == ['f'])
+    assert(run("(apply1 (lambda (x) (+ x 1)))") == 3)
+    assert(localEnv['apply1'].bytecode.names == ['f', 'z'])
+    assert(run("(apply1 quoted)") == [Atom('label'), [Atom('z'), [2, nil]]])
+
+    # Lambdas move between the VM and the closures
+    assert(evaluate("(walk numbers 0)", localEnv) == sum(range(size)))
+    evaluate("(label inc (lambda (x) (+ x 1)))", localEnv)
+    assert(run("(inc 1)") == 2)
+    assert(run("(cons (inc 1) nil)") == [2, nil])
+
+
 def test():
     test_tokenizer()
     test_parser()
     test_evaluator()
     test_prims()
     test_macros()
+    test_environments()
+    test_compiler()
+    test_tail_calls()
+    test_lexical_addressing()
+    test_vm()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,184 @@
+# -*- coding: utf-8; -*-
+#
+# bench.py - Compare the engines of peg.py on generated inputs
+#
+# Copyright (C) 2018  Lincoln Clarete
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import peg
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def genCsv(size, rand):
+    rows, length = [], 0
+    while length < size:
+        row = ','.join(
+            ''.join(rand.choice('abcdefghij0123456789 -') for _ in range(rand.randint(0, 12)))
+            for _ in range(rand.randint(1, 8))) + '\n'
+        rows.append(row)
+        length += len(row)
+    return ''.join(rows)
+
+
+def genArith(size, rand):
+    # `Add' and `Mul' are right recursive, so the number of terms is
+    # capped to keep the recursive engines within Python's stack.
+    # Bigger inputs get longer numbers instead.
+    terms = max(1, min(size // 8, 200))
+    digits = max(1, size // terms - 4)
+    def num(): return ''.join(rand.choice('0123456789') for _ in range(digits))
+    out = []
+    for _ in range(terms):
+        if rand.random() < 0.2: out.append('(%s+%s)' % (num(), num()))
+        else: out.append(num())
+        out.append(rand.choice('+*'))
+    return ''.join(out[:-1])
+
+
+def genGrammar(size, rand):
+    with io.open(os.path.join(here, 'peg.g')) as f:
+        source = f.read()
+    return source * max(1, size // len(source))
+
+
+# Grammar source, start rule and input generator of each workload
+workloads = {
+    'csv': (peg.csv, 'File', genCsv),
+    'arith': (peg.arith, 'Add', genArith),
+    'peg.g': (None, 'Grammar', genGrammar),
+}
+
+
+def engines(grammar, start):
+    """Yield `(name, run)', `run' returns the end of the match and backtracks
+
+    Backtracks are only counted by `run(data, profile=True)', they're
+    None for the engines that can't count them.
+    """
+    def evalEngine(packrat):
+        def run(data, profile=False):
+            e = peg.Eval(grammar, start, data, packrat=packrat,
+                         profile=peg.Profile(grammar) if profile else None)
+            match, _ = e.run()
+            return (e.pos if match else None), e.backtracks if profile else None
+        return run
+    yield 'eval', evalEngine(False)
+    yield 'eval-packrat', evalEngine(True)
+
+    closures = peg.ClosureCompiler(grammar)
+    def runClosures(data, profile=False):
+        r = closures.match(start, data)
+        return (r[0] if r else None), None
+    yield 'closures', runClosures
+
+    program = peg.Compiler(grammar, start).run()
+    def runMachine(data, profile=False):
+        m = peg.Machine(program, profile)
+        return m.match(data), m.backtracks if profile else None
+    yield 'vm', runMachine
+
+    try:
+        cmachine = peg.CMachine(program)
+    except Exception:
+        return
+    def runCMachine(data, profile=False):
+        return cmachine.match(data), None
+    yield 'cvm', runCMachine
+
+
+def measure(run, data, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        end, _ = run(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # Counting backtracks costs time too
+    _, backtracks = run(data, profile=True)
+    # Tracing allocations slows everything down, so memory is measured
+    # in a run of its own.  Memory allocated by the C machine isn't seen.
+    tracemalloc.start()
+    run(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    size = len(data.encode('utf-8'))
+    return {
+        'bytes': size,
+        'consumed': end,
+        'seconds': best,
+        'throughput': size / best if best else None,
+        'peakMemory': peak,
+        'backtracks': backtracks,
+    }
+
+
+def bench(names, sizes, engineNames=None, repeat=3, seed=0):
+    results = []
+    for name in names:
+        source, start, generate = workloads[name]
+        if source is None:
+            with io.open(os.path.join(here, name)) as f:
+                source = f.read()
+        grammar = peg.Parser(source).parse()
+        for size in sizes:
+            data = generate(size, random.Random(seed))
+            for engine, run in engines(grammar, start):
+                if engineNames and engine not in engineNames: continue
+                result = {'grammar': name, 'engine': engine}
+                result.update(measure(run, data, repeat))
+                results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the peg.py engines and print the results as JSON')
+    parser.add_argument(
+        '-g', '--grammar', dest='grammars', action='append',
+        choices=sorted(workloads),
+        help='Workload to run. Can be repeated. Defaults to all of them')
+    parser.add_argument(
+        '-e', '--engine', dest='engines', action='append',
+        choices=['eval', 'eval-packrat', 'closures', 'vm', 'cvm'],
+        help='Engine to run. Can be repeated. Defaults to all of them')
+    parser.add_argument(
+        '-s', '--size', dest='sizes', action='append', type=int,
+        help='Size of the generated input in bytes. Can be repeated')
+    parser.add_argument(
+        '-r', '--repeat', dest='repeat', action='store', type=int, default=3,
+        help='Runs per measurement, the fastest one is reported')
+    parser.add_argument(
+        '--seed', dest='seed', action='store', type=int, default=0,
+        help='Seed for the input generators')
+    args = parser.parse_args()
+    results = bench(args.grammars or sorted(workloads), args.sizes or [10000],
+                    args.engines, args.repeat, args.seed)
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -20,12 +20,26 @@
 from __future__ import print_function
 
 import argparse
+import array
+import bisect
+import codecs
+import concurrent.futures
+import ctypes
 import enum
 import functools
+import hashlib
 import io
+import mmap
 import os
+import pickle
 import pprint
+import re
+import stat
 import struct
+import subprocess
+import sys
+import tempfile
+import time
 
 class TokenTypes(enum.Enum):
     (IDENTIFIER,
@@ -45,6 +59,7 @@ class TokenTypes(enum.Enum):
     ) = range(14)
 
 class Token:
+    __slots__ = ('_type', 'value', 'line', 'pos')
     def __init__(self, _type, value=None, line=0, pos=0):
         self._type = _type
         self.value = value
@@ -63,6 +78,9 @@ class Token:
                 other.pos == self.pos)
 
 class Node:
+    # Grammars are made of lots of small nodes, no need for a __dict__
+    # on each one of them
+    __slots__ = ('value',)
     def __init__(self, value=None):
         self.value = value
     def __repr__(self):
@@ -72,27 +90,62 @@ class Node:
         return (isinstance(other, self.__class__) and
                 other.value == self.value)
 
-class And(Node): pass
+class And(Node): __slots__ = ()
 
-class Not(Node): pass
+class Not(Node): __slots__ = ()
 
-class Question(Node): pass
+class Question(Node): __slots__ = ()
 
-class Star(Node): pass
+class Star(Node): __slots__ = ()
 
-class Plus(Node): pass
+class Plus(Node): __slots__ = ()
 
-class Expression(Node): pass
+class Expression(Node): __slots__ = ()
 
-class Sequence(Node): pass
+class Sequence(Node): __slots__ = ()
 
-class Identifier(Node): pass
+class Identifier(Node): __slots__ = ()
 
-class Literal(Node): pass
+class Literal(Node): __slots__ = ()
 
-class Class(Node): pass
+class CharSet:
+    """Chars of a `Class' in a structure that is cheap to query
 
-class Dot(Node): pass
+    Chars up to 0xff are looked up in a 256 entry table. The ones
+    above that are kept as sorted, merged intervals and are found
+    with a binary search.
+    """
+    __slots__ = ('table', 'lefts', 'rights')
+    def __init__(self, value):
+        ranges = value if isinstance(value, list) else [[c, c] for c in value]
+        self.table = bytearray(256)
+        high = []
+        for [left, right] in ranges:
+            left, right = ord(left), ord(right)
+            for c in range(left, min(right, 0xff) + 1):
+                self.table[c] = 1
+            if right > 0xff:
+                high.append([max(left, 0x100), right])
+        self.lefts, self.rights = [], []
+        for [left, right] in sorted(high):
+            if self.rights and left <= self.rights[-1] + 1:
+                self.rights[-1] = max(self.rights[-1], right)
+            else:
+                self.lefts.append(left)
+                self.rights.append(right)
+    def __contains__(self, char):
+        c = ord(char)
+        if c <= 0xff: return self.table[c] == 1
+        i = bisect.bisect_right(self.lefts, c) - 1
+        return i >= 0 and c <= self.rights[i]
+
+class Class(Node):
+    __slots__ = ('chars',)
+    def __init__(self, value=None):
+        Node.__init__(self, value)
+        self.chars = CharSet(value or '')
+
+class Dot(Node): __slots__ = ()
 
 def fio(thing):
     "first if only"
@@ -102,37 +155,58 @@ def fio(thing):
 
 class Parser:
 
+    # The lexer matches whole tokens with regular expressions instead
+    # of reading the grammar char by char.  Spacing is whitespace,
+    # comments and the two chars `\\n', which count as a new line.
+    # Other backslashes between tokens are skipped.
+    SPACING = re.compile(r'(\\n)|\s+|#[^\n]*|\\')
+    TOKENS = re.compile('|'.join([
+        r'(?P<IDENTIFIER>[^\W\d_][^\W_]*)',
+        r"""(?P<LITERAL>'(?:\\.|[^'\\])*'|"(?:\\.|[^"\\])*")""",
+        r'(?P<CLASS>\[(?:\\.|[^\]\\])*\])',
+        r'(?P<ARROW><-)',
+        r'(?P<OPEN>\()',
+        r'(?P<CLOSE>\))',
+        r'(?P<PRIORITY>/)',
+        r'(?P<DOT>\.)',
+        r'(?P<STAR>\*)',
+        r'(?P<PLUS>\+)',
+        r'(?P<NOT>!)',
+        r'(?P<AND>&)',
+        r'(?P<QUESTION>\?)',
+    ]), re.S)
+    ESCAPES = {'n': '\n', 'r': '\r', 't': '\t', "'": "'", '"': '"',
+               '[': '[', ']': ']', '\\': '\\'}
+    # Errors for the chars that start a token that didn't match
+    BROKEN = {'<': "Missing the dash in the arrow",
+              "'": "Expected end of string",
+              '"': "Expected end of string",
+              '[': "Expected end of class"}
+
     def __init__(self, code):
         self.code = code
         self.pos = 0
         self.line = 0
         self.token_start = 0
         self.token = None
-
-    def peekc(self, n=0):
-        if self.pos+n >= len(self.code): return None
-        return self.code[self.pos+n]
-
-    def nextc(self, n=1):
-        self.pos += n
-        return self.peekc()
-
-    def testc(self, c, n=0):
-        return self.peekc(n) == c
-
-    def matchc(self, c):
-        if not self.testc(c): return False
-        self.nextc()
-        return True
+        self.tokens = None
+        self.index = 0
 
     def peekt(self):
-        d = self.pos
-        value = self.lex()
-        self.pos = d
-        return value
+        value = self.tokens[self.index]
+        return value if isinstance(value, Token) else self.t(TokenTypes.END)
 
     def nextt(self):
-        self.token = self.lex()
+        # The whole grammar is tokenized at once.  A lexing error is
+        # kept in place of the token it would be, and only raised when
+        # the parser gets to it
+        if self.tokens is None: self.tokens = self.tokenize()
+        token = self.tokens[self.index]
+        if not isinstance(token, Token):
+            exc, self.token_start, self.line = token
+            raise exc
+        self.token, self.token_start, self.line = token, token.pos, token.line
+        self.index += 1
         return self.token
 
     def testt(self, t):
@@ -152,101 +226,68 @@ class Parser:
     def t(self, _type, value=None):
         return Token(_type, value, line=self.line, pos=self.token_start)
 
-    def lex(self):
-        self.spacing()
-        self.token_start = self.pos
-        if self.peekc() is None: return self.t(TokenTypes.END)
-
-        # Identifier <- IdentStart IdentCont* Spacing
-        if self.peekc().isalpha():
-            d = self.pos
-            while self.peekc() and self.peekc().isalnum():
-                self.pos += 1
-            return self.t(TokenTypes.IDENTIFIER, self.code[d:self.pos])
-        # Literal <- ['] (!['] Char)* ['] Spacing
-        elif self.matchc("'"):
-            return self.lexLiteral("'")
-        # / ["] (!["] Char)* ["] Spacing
-        elif self.matchc('"'):
-            return self.lexLiteral('"')
-        # Range <- ’[’ (!’]’ Range)* ’]’ Spacing
-        elif self.matchc('['):
-            return self.lexRange()
-        # LEFTARROW ’<-’
-        elif self.matchc('<'):
-            if self.matchc('-'): return self.t(TokenTypes.ARROW)
-            else: raise SyntaxError("Missing the dash in the arrow")
-        elif self.matchc('('):
-            return self.t(TokenTypes.OPEN)
-        elif self.matchc(')'):
-            return self.t(TokenTypes.CLOSE)
-        elif self.matchc('/'):
-            return self.t(TokenTypes.PRIORITY)
-        elif self.matchc('.'):
-            return self.t(TokenTypes.DOT)
-        elif self.matchc('*'):
-            return self.t(TokenTypes.STAR)
-        elif self.matchc('+'):
-            return self.t(TokenTypes.PLUS)
-        elif self.matchc('!'):
-            return self.t(TokenTypes.NOT)
-        elif self.matchc('&'):
-            return self.t(TokenTypes.AND)
-        elif self.matchc('?'):
-            return self.t(TokenTypes.QUESTION)
-        else:
-            raise SyntaxError("Unexpected char `{}'".format(self.peekc()))
-
-    def lexRange(self):
-        ranges = []
-        chars = []
-        # Range <- Char ’-’ Char / Char
-        while not self.testc(']'):
-            left = self.lexChar()
-            if self.matchc('-'): ranges.append([left, self.lexChar()])
-            else: chars.append(left)
-        if not self.matchc(']'): raise SyntaxError("Expected end of class")
-        return self.t(TokenTypes.CLASS, ranges or ''.join(chars))
-
-    def lexChar(self):
-        # Char <- '\\' [nrt'"\[\]\\]
-        if self.matchc('\\'):
-            if self.matchc('n'): return '\n'
-            elif self.matchc('r'): return '\r'
-            elif self.matchc('t'): return '\t'
-            elif self.matchc('\''): return '\''
-            elif self.matchc('"'): return '"'
-            elif self.matchc('['): return '['
-            elif self.matchc(']'): return ']'
-            elif self.matchc('\\'): return '\\'
-            elif self.peekc() is None: SyntaxError('Unexpected end of input')
-            else: raise SyntaxError('Unknown escape char `{}`'.format(self.peekc()))
-        value = self.peekc()
-        self.nextc()
-        return value
-
-    def lexLiteral(self, end):
-        output = []
-        while self.peekc() and not self.testc(end):
-            output.append(self.lexChar())
-        if not self.matchc(end): raise SyntaxError("Expected end of string")
-        return self.t(TokenTypes.LITERAL, ''.join(output))
-
-    def spacing(self):
-        self.cleanspaces()
-        # ’#’ (!EndOfLine .)* EndOfLine
-        if self.matchc('#'):
-            while not self.testc('\n') and self.peekc():
-                self.nextc()
-            self.cleanspaces()
-
-    def cleanspaces(self):
+    def tokenize(self):
+        code, tokens, pos, line = self.code, [], 0, 0
+        spacing, match = self.SPACING.match, self.TOKENS.match
         while True:
-            if self.matchc('\\'):
-                if self.matchc('n'):
-                    self.line += 1
-            elif self.peekc() and self.peekc().isspace(): self.nextc()
-            else: break
+            while True:
+                m = spacing(code, pos)
+                if m is None: break
+                if m.group(1): line += 1
+                pos = m.end()
+            if pos >= len(code):
+                tokens.append(Token(TokenTypes.END, line=line, pos=pos))
+                return tokens
+            m = match(code, pos)
+            try:
+                if m is None:
+                    raise SyntaxError(self.BROKEN.get(
+                        code[pos], "Unexpected char `{}'".format(code[pos])))
+                tokens.append(self.lexToken(m.lastgroup, m.group(), line, pos))
+            except SyntaxError as exc:
+                tokens.append((exc, pos, line))
+                return tokens
+            pos = m.end()
+
+    def lexToken(self, name, text, line, pos):
+        _type = TokenTypes[name]
+        if _type == TokenTypes.IDENTIFIER:
+            value = text
+        elif _type == TokenTypes.LITERAL:
+            value = ''.join(self.unescape(text[1:-1]))
+        elif _type == TokenTypes.CLASS:
+            value = self.ranges(self.unescape(text[1:-1]))
+        else:
+            value = None
+        return Token(_type, value, line=line, pos=pos)
+
+    def unescape(self, text):
+        # Char <- '\\' [nrt'"\[\]\\] / !'\\' .
+        chars, i = [], 0
+        while i < len(text):
+            if text[i] == '\\':
+                i += 1
+                if text[i] not in self.ESCAPES:
+                    raise SyntaxError('Unknown escape char `{}`'.format(text[i]))
+                chars.append(self.ESCAPES[text[i]])
+            else:
+                chars.append(text[i])
+            i += 1
+        return chars
+
+    def ranges(self, chars):
+        # Range <- Char '-' Char / Char
+        ranges, single, i = [], [], 0
+        while i < len(chars):
+            if i + 2 < len(chars) and chars[i+1] == '-':
+                ranges.append([chars[i], chars[i+2]])
+                i += 3
+            else:
+                single.append(chars[i])
+                i += 1
+        # Single chars become ranges of one char when mixed with ranges
+        if ranges: ranges.extend([c, c] for c in single)
+        return ranges or ''.join(single)
 
     def parseDefinitions(self):
         # Grammar <- Spacing Definition+ EndOfFile
@@ -265,41 +306,54 @@ class Parser:
 
     def parseExpression(self):
         # Expression <- Sequence (SLASH Sequence)*
-        output = [self.parseSequence()]
-        while self.matcht(TokenTypes.PRIORITY):
-            output.append(self.parseSequence())
-        # We don't need to create a new expression when there's only
-        # one element so we save a lil recursion here and there
-        if len(output) > 1: return Expression(output)
-        else: return fio(output)
-
-    def parseSequence(self):
-        # Sequence <- Prefix*
-        output = []
+        # Sequence   <- Prefix*
+        # Prefix     <- (AND / NOT)? Suffix
+        #
+        # Parenthesized expressions don't recurse.  The choices and
+        # the sequence read so far are saved in a stack along with the
+        # prefix of the parenthesis, and restored when it's closed.
+        stack, choices, sequence = [], [], []
         while True:
-            # Prefix <- (AND / NOT)? Suffix
-            prefix = lambda x: x
+            prefix = None
             if self.matcht(TokenTypes.AND): prefix = And
             elif self.matcht(TokenTypes.NOT): prefix = Not
-            suffix = self.parseSuffix()
-            if suffix is None: break
-            output.append(prefix(suffix))
-        if len(output) > 1: return Sequence(output)
-        else: return fio(output)
-
-    def parseSuffix(self):
+            if self.matcht(TokenTypes.OPEN):
+                if self.matcht(TokenTypes.CLOSE):
+                    primary = []
+                else:
+                    stack.append((choices, sequence, prefix))
+                    choices, sequence = [], []
+                    continue
+            else:
+                primary = self.parsePrimary()
+            if primary is None:
+                # We don't need to create a new sequence or expression
+                # when there's only one element so we save a lil
+                # recursion here and there
+                choices.append(Sequence(sequence) if len(sequence) > 1 else fio(sequence))
+                sequence = []
+                if self.matcht(TokenTypes.PRIORITY): continue
+                expression = Expression(choices) if len(choices) > 1 else fio(choices)
+                if not stack: return expression
+                self.consumet(TokenTypes.CLOSE)
+                choices, sequence, prefix = stack.pop()
+                primary = expression
+            suffix = self.parseSuffix(primary)
+            sequence.append(prefix(suffix) if prefix else suffix)
+
+    def parseSuffix(self, primary):
         # Suffix <- Primary (QUESTION / STAR / PLUS)?
-        output = [self.parsePrimary()]
-        suffix = lambda x: x
-        if self.matcht(TokenTypes.QUESTION): suffix = Question
-        elif self.matcht(TokenTypes.STAR): suffix = Star
-        elif self.matcht(TokenTypes.PLUS): suffix = Plus
-        return suffix(fio(output))
+        if self.matcht(TokenTypes.QUESTION): return Question(primary)
+        elif self.matcht(TokenTypes.STAR): return Star(primary)
+        elif self.matcht(TokenTypes.PLUS): return Plus(primary)
+        return primary
 
     def parsePrimary(self):
         # Primary <- Identifier !LEFTARROW
         #          / OPEN Expression CLOSE
         #          / Literal / Class / DOT
+        #
+        # Parenthesized expressions are handled by `parseExpression()'
         if self.testt(TokenTypes.IDENTIFIER) and self.peekt()._type != TokenTypes.ARROW:
             return Identifier(self.consumet(TokenTypes.IDENTIFIER).value)
         if self.testt(TokenTypes.LITERAL):
@@ -308,11 +362,6 @@ class Parser:
             return Class(self.consumet(TokenTypes.CLASS).value)
         elif self.matcht(TokenTypes.DOT):
             return Dot()
-        elif self.matcht(TokenTypes.OPEN):
-            if self.matcht(TokenTypes.CLOSE): return []
-            value = self.parseExpression()
-            self.consumet(TokenTypes.CLOSE)
-            return value
         return None
 
     def parse(self):
@@ -341,43 +390,541 @@ def mergeDicts(dicts):
     return {x: y for di in dicts for x, y in di.items()}
 
 
+class Analyzer:
+
+    """Static checks over a grammar
+
+    Computes which rules can succeed without consuming any input
+    (nullable) and which chars each rule can start with (FIRST).  Both
+    are found by going over all the rules until nothing changes.  FIRST
+    sets are kept as sets of `(left, right)' code point intervals, or
+    None when any char can start the match.  Predicates consume nothing
+    so they're nullable and don't add to FIRST, which makes both sets
+    conservative: an expression that isn't nullable can't match if
+    the current char isn't in its FIRST set.  Unknown rules are taken
+    as nullable with any char in FIRST, so they're always tried and
+    the error surfaces when they're called.
+    """
+
+    def __init__(self, grammar):
+        self.g = mergeDicts(grammar)
+        self.tables = {}
+        self.nullables = {name: False for name in self.g}
+        self.firsts = {name: frozenset() for name in self.g}
+        changed = True
+        while changed:
+            changed = False
+            for name, atom in self.g.items():
+                nullable, first = self.isNullable(atom), self.firstRanges(atom)
+                if nullable != self.nullables[name] or first != self.firsts[name]:
+                    self.nullables[name], self.firsts[name] = nullable, first
+                    changed = True
+
+    def isNullable(self, atom):
+        if isinstance(atom, Literal): return not atom.value
+        elif isinstance(atom, (Class, Dot)): return False
+        elif isinstance(atom, Identifier): return self.nullables.get(atom.value, True)
+        elif isinstance(atom, (Not, And, Question, Star)): return True
+        elif isinstance(atom, Plus): return self.isNullable(atom.value)
+        elif isinstance(atom, Sequence): return all(self.isNullable(a) for a in atom.value)
+        elif isinstance(atom, Expression): return any(self.isNullable(a) for a in atom.value)
+        else: raise Exception("Unknown atom %s" % atom)
+
+    def firstRanges(self, atom):
+        if isinstance(atom, Literal):
+            return frozenset((ord(c), ord(c)) for c in atom.value[:1])
+        elif isinstance(atom, Class):
+            value = atom.value or ''
+            ranges = value if isinstance(value, list) else [[c, c] for c in value]
+            return frozenset((ord(left), ord(right)) for [left, right] in ranges)
+        elif isinstance(atom, Dot): return None
+        elif isinstance(atom, Identifier):
+            if atom.value not in self.g: return None
+            return self.firsts[atom.value]
+        elif isinstance(atom, (Not, And)): return frozenset()
+        elif isinstance(atom, (Question, Star, Plus)): return self.firstRanges(atom.value)
+        elif isinstance(atom, (Sequence, Expression)):
+            first = frozenset()
+            for a in atom.value:
+                ranges = self.firstRanges(a)
+                if ranges is None: return None
+                first |= ranges
+                if isinstance(atom, Sequence) and not self.isNullable(a): break
+            return first
+        else: raise Exception("Unknown atom %s" % atom)
+
+    def first(self, atom):
+        "FIRST set of `atom' as a `CharSet', or None if it's any char"
+        ranges = self.firstRanges(atom)
+        if ranges is None: return None
+        return CharSet([[chr(left), chr(right)] for left, right in sorted(ranges)])
+
+    def onlyChar(self, atom):
+        "The only char `atom' can start with, if there's one"
+        if self.isNullable(atom): return None
+        ranges = self.firstRanges(atom)
+        if ranges and len(ranges) == 1:
+            [(left, right)] = ranges
+            if left == right: return chr(left)
+        return None
+
+    def dispatch(self, atom, values=None):
+        "Table of the alternatives of the Expression `atom' per char"
+        if values is not None: return Dispatch(self, atom.value, values)
+        table = self.tables.get(id(atom))
+        if table is None:
+            table = self.tables[id(atom)] = Dispatch(self, atom.value, atom.value)
+        return table
+
+    def leftCalls(self, atom):
+        # Rules that can be called without consuming input first
+        if isinstance(atom, Identifier): return [atom.value]
+        elif isinstance(atom, (Not, And, Question, Star, Plus)):
+            return self.leftCalls(atom.value)
+        elif isinstance(atom, (Sequence, Expression)):
+            calls = []
+            for a in atom.value:
+                calls.extend(self.leftCalls(a))
+                if isinstance(atom, Sequence) and not self.isNullable(a): break
+            return calls
+        return []
+
+    def isLeftRecursive(self, name):
+        visited, stack = set(), self.leftCalls(self.g[name])
+        while stack:
+            callee = stack.pop()
+            if callee == name: return True
+            if callee in visited or callee not in self.g: continue
+            visited.add(callee)
+            stack.extend(self.leftCalls(self.g[callee]))
+        return False
+
+    def walk(self, atom):
+        yield atom
+        if isinstance(atom, (Not, And, Question, Star, Plus)):
+            yield from self.walk(atom.value)
+        elif isinstance(atom, (Sequence, Expression)):
+            for a in atom.value: yield from self.walk(a)
+
+    def errors(self):
+        errors = []
+        for name, atom in self.g.items():
+            if self.isLeftRecursive(name):
+                errors.append("Rule %s is left recursive" % name)
+            for a in self.walk(atom):
+                if isinstance(a, Identifier) and a.value not in self.g:
+                    errors.append("Rule %s uses unknown rule %s" % (name, a.value))
+                elif isinstance(a, (Star, Plus)) and self.isNullable(a.value):
+                    errors.append("Rule %s repeats an expression that matches "
+                                  "the empty string" % name)
+        return errors
+
+    def check(self):
+        errors = self.errors()
+        if errors: raise Exception('\n'.join(errors))
+        return self
+
+
+class Dispatch:
+
+    """Alternatives of an ordered choice that can match at each char
+
+    An alternative that isn't nullable can only match if the current
+    char is in its FIRST set, so the others are skipped without being
+    tried.  The order of the candidates is kept, so the first one that
+    matches is still the one the full choice would have picked.  Chars
+    up to 0xff are looked up in a table, the other ones are filtered
+    when they show up.  `values' are what gets returned for each
+    alternative, e.g. its node or its compiled closure.
+    """
+
+    def __init__(self, analyzer, alternatives, values):
+        self.entries = [(value, analyzer.isNullable(a), analyzer.first(a))
+                        for a, value in zip(alternatives, values)]
+        # At the end of the input only nullable alternatives can match
+        self.end = tuple(value for value, nullable, _ in self.entries if nullable)
+        self.table, interned = [], {}
+        for c in range(256):
+            key = tuple(i for i, (_, nullable, first) in enumerate(self.entries)
+                        if nullable or first is None or first.table[c])
+            if key not in interned:
+                interned[key] = tuple(self.entries[i][0] for i in key)
+            self.table.append(interned[key])
+
+    def candidates(self, char):
+        if char is None: return self.end
+        c = ord(char)
+        if c <= 0xff: return self.table[c]
+        return [value for value, nullable, first in self.entries
+                if nullable or first is None or char in first]
+
+
+class Stream:
+
+    """Input read in chunks from a file-like object (or an mmap)
+
+    It can be indexed and sliced with absolute positions like a `str'
+    and raises IndexError past the end of the input, so `Eval' and
+    `ClosureCompiler' can take it instead of the whole data.  Chunks
+    are read as positions are reached.  `release(pos)' tells the
+    stream that nothing before `pos' will be read again, and that
+    part of the buffer is dropped when the next chunk is read.
+    """
+
+    def __init__(self, fileobj, chunkSize=1 << 16, encoding='utf-8'):
+        self.f = fileobj
+        self.chunkSize = chunkSize
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.buffer = ''
+        self.offset = 0         # Absolute position of buffer[0]
+        self.released = 0
+        self.eof = False
+
+    def fill(self, pos):
+        while not self.eof and pos >= self.offset + len(self.buffer):
+            chunk = self.f.read(self.chunkSize)
+            self.eof = not chunk
+            if isinstance(chunk, bytes):
+                chunk = self.decoder.decode(chunk, final=self.eof)
+            self.buffer = self.buffer[self.released - self.offset:] + chunk
+            self.offset = self.released
+
+    def check(self, pos):
+        if pos < self.offset:
+            raise Exception("Position %d was already released" % pos)
+
+    def release(self, pos):
+        self.released = max(self.released, pos)
+
+    def startswith(self, prefix, pos):
+        self.fill(pos + len(prefix) - 1)
+        self.check(pos)
+        return self.buffer.startswith(prefix, pos - self.offset)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            self.fill(key.stop - 1)
+            self.check(key.start)
+            return self.buffer[key.start - self.offset:key.stop - self.offset]
+        self.fill(key)
+        self.check(key)
+        return self.buffer[key - self.offset]
+
+
+def mapFile(f):
+    """Map the file `f' for the machines to index its pages directly
+
+    Mapped bytes can't be decoded, so only ASCII input is taken, where
+    bytes and code points are the same thing.  ACCESS_COPY keeps the
+    map writable so ctypes can share it.
+    """
+    # Empty files can't be mapped
+    if os.fstat(f.fileno()).st_size == 0: return b''
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    found = re.search(rb'[\x80-\xff]', data)
+    if found:
+        data.close()
+        raise Exception("Non ASCII byte at %d, run without --stream" % found.start())
+    return data
+
+
+class Profile:
+
+    """Time and backtracking of each rule of a grammar
+
+    Filled in by `Eval' and `ClosureCompiler' when they get one.  For
+    each rule it counts calls, successes, failures and chars consumed,
+    along with the time spent in the rule (`total') and in the rule
+    minus the rules it called (`own').  Time spent in recursive calls
+    is only added once to `total'.  Alternatives of ordered choices are
+    named `Rule/n' after the rule they're in, or `Rule#e/n' when the
+    rule has more than one choice, and count how many times they were
+    tried and rejected.
+    """
+
+    def __init__(self, grammar):
+        self.rules = {}
+        self.alternatives = {}
+        self.labels = {}
+        self.stack = []
+        self.active = {}
+        for name, atom in mergeDicts(grammar).items():
+            expressions, nodes = [], [atom]
+            while nodes:
+                node = nodes.pop()
+                if isinstance(node, Expression): expressions.append(node)
+                if isinstance(node, (Sequence, Expression)): nodes.extend(reversed(node.value))
+                elif isinstance(node, (Not, And, Question, Star, Plus)): nodes.append(node.value)
+            for e, expression in enumerate(expressions):
+                prefix = name if e == 0 else '%s#%d' % (name, e + 1)
+                for i, alternative in enumerate(expression.value):
+                    self.labels[id(alternative)] = '%s/%d' % (prefix, i + 1)
+
+    def enter(self, name):
+        self.stack.append(0.0)
+        self.active[name] = self.active.get(name, 0) + 1
+        return time.perf_counter()
+
+    def leave(self, name, started, match, consumed):
+        elapsed = time.perf_counter() - started
+        callees = self.stack.pop()
+        if self.stack: self.stack[-1] += elapsed
+        self.active[name] -= 1
+        stats = self.rules.get(name)
+        if stats is None:
+            stats = self.rules[name] = {'calls': 0, 'successes': 0, 'failures': 0,
+                                        'consumed': 0, 'total': 0.0, 'own': 0.0}
+        stats['calls'] += 1
+        if match:
+            stats['successes'] += 1
+            stats['consumed'] += consumed
+        else:
+            stats['failures'] += 1
+        stats['own'] += elapsed - callees
+        if not self.active[name]: stats['total'] += elapsed
+
+    def tried(self, alternative, match):
+        label = self.labels.get(id(alternative), '?')
+        stats = self.alternatives.get(label)
+        if stats is None: stats = self.alternatives[label] = {'tried': 0, 'rejected': 0}
+        stats['tried'] += 1
+        if not match: stats['rejected'] += 1
+
+    def report(self, out=None, sort='own'):
+        out = out or sys.stdout
+        out.write('%8s %8s %8s %10s %10s %10s  %s\n' % (
+            'calls', 'ok', 'failed', 'consumed', 'own', 'total', 'rule'))
+        for name, stats in sorted(self.rules.items(), key=lambda r: -r[1][sort]):
+            out.write('%8d %8d %8d %10d %10.6f %10.6f  %s\n' % (
+                stats['calls'], stats['successes'], stats['failures'],
+                stats['consumed'], stats['own'], stats['total'], name))
+        if not self.alternatives: return
+        out.write('\n%8s %8s  %s\n' % ('tried', 'rejected', 'alternative'))
+        for label, stats in sorted(self.alternatives.items(), key=lambda a: -a[1]['rejected']):
+            out.write('%8d %8d  %s\n' % (stats['tried'], stats['rejected'], label))
+
+
+def materialize(value, data):
+    """Output of a parse in span mode with the spans replaced by text
+
+    Values have the same shape the parse would have produced without
+    spans, except for repetitions of text, like `[0-9]+', which are a
+    single string instead of a list of strings.  With a `Stream', only
+    spans that weren't released yet can be materialized.
+    """
+    if isinstance(value, tuple): return data[value[0]:value[1]]
+    elif isinstance(value, list): return [materialize(v, data) for v in value]
+    return value
+
+
+def copyLists(value):
+    "Copy of the lists of an output, everything else in it is immutable"
+    if isinstance(value, list): return [copyLists(v) for v in value]
+    return value
+
+
+class Tree:
+
+    """Parse trees of span mode kept in flat arrays
+
+    Lists of the output become internal nodes and spans become leaves,
+    None is a leaf without a span.  Nodes are stored in preorder, so
+    the first child of a node comes right after it and each child is
+    followed by its whole subtree: `sizes' is enough to walk them and
+    `parents' to go back up.  Internal nodes get the span that covers
+    their leaves.  Each node costs a few machine integers instead of
+    a list or a tuple, which matters for large inputs, especially when
+    the records of `Eval.iterate()' are added as they're parsed.
+    """
+
+    LEAF, LIST = 0, 1
+
+    def __init__(self, data=None):
+        self.data = data
+        self.kinds = array.array('b')
+        self.starts, self.ends = array.array('l'), array.array('l')
+        self.sizes, self.parents = array.array('l'), array.array('l')
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def node(self, kind, parent, start=-1, end=-1):
+        self.kinds.append(kind); self.parents.append(parent)
+        self.starts.append(start); self.ends.append(end)
+        self.sizes.append(1)
+        return len(self.kinds) - 1
+
+    def add(self, value, parent=-1):
+        "Add `value' as the last child of `parent' and return its index"
+        root, stack = len(self), [(value, parent)]
+        # Lists are closed after their children, which are added in
+        # order, to get their size and span
+        while stack:
+            value, parent = stack.pop()
+            if value is Tree:
+                self.close(parent)
+            elif isinstance(value, list):
+                i = self.node(self.LIST, parent)
+                stack.append((Tree, i))
+                stack.extend((v, i) for v in reversed(value))
+            elif isinstance(value, tuple):
+                self.node(self.LEAF, parent, value[0], value[1])
+            elif value is None:
+                self.node(self.LEAF, parent)
+            else:
+                raise TypeError("Tree takes values of span mode, not %r" % (value,))
+        return root
+
+    def close(self, i):
+        self.sizes[i] = len(self) - i
+        for c in self.children(i):
+            if self.starts[c] < 0: continue
+            if self.starts[i] < 0: self.starts[i] = self.starts[c]
+            self.ends[i] = self.ends[c]
+
+    def extend(self, values):
+        for value in values: self.add(value)
+
+    def children(self, i=-1):
+        "Indices of the children of `i', or of the roots by default"
+        j, end = i + 1, len(self) if i < 0 else i + self.sizes[i]
+        while j < end:
+            yield j
+            j += self.sizes[j]
+
+    def span(self, i):
+        if self.starts[i] < 0: return None
+        return self.starts[i], self.ends[i]
+
+    def text(self, i):
+        span = self.span(i)
+        return None if span is None else self.data[span[0]:span[1]]
+
+    def value(self, i):
+        "The value `i' was made from, spans and all"
+        out = []
+        for j in range(i + self.sizes[i] - 1, i - 1, -1):
+            if self.kinds[j] == self.LEAF:
+                out.append(self.span(j))
+            else:
+                count = sum(1 for _ in self.children(j))
+                children = out[len(out) - count:][::-1]
+                del out[len(out) - count:]
+                out.append(children)
+        return out[0]
+
+
 class Eval:
 
-    def __init__(self, grammar, start, data):
+    def __init__(self, grammar, start, data, packrat=False, memoLimit=None,
+                 profile=None, spans=False, actions=None, incremental=False,
+                 analyzer=None):
         self.g = mergeDicts(grammar)
         self.start = start
         self.data = data
         self.pos = 0
+        # Packrat mode caches the result of each rule at each input
+        # position, so backtracking into a rule that was already tried
+        # at the same position doesn't evaluate it again.  The memo
+        # table is indexed by position first, so entries left behind
+        # by the cursor can be dropped in bulk once `memoLimit' is hit.
+        self.memo = {}
+        self.memoSize = 0
+        self.memoLimit = memoLimit
+        # Incremental mode is packrat mode that also records how far
+        # each memoized rule looked into the input, so `edit()' knows
+        # which entries an edit can change
+        self.examined = 0
+        self.incremental = incremental
+        if incremental:
+            packrat = True
+            self.current = self.currentTracked
+            self.advance = self.advanceTracked
+        # Dispatch tables of each Expression, built when it's first
+        # evaluated.  Evals of the same grammar can share its `Analyzer'
+        self.analyzer = analyzer
+        self.dispatch = {}
+        # Failures recovered by a choice, repetition or predicate.
+        # Only counted when profiling
+        self.backtracks = 0
+        # Span mode returns `(start, end)' tuples instead of slices of
+        # the input, see `materialize()'
+        self.textual = {}
+        if spans:
+            self.ret = self.retSpan
+            self.evalClass = self.evalClassSpan
+            self.evalStar = self.evalStarSpan
+            self.evalPlus = self.evalPlusSpan
+        # With actions, only rules produce values: the result of their
+        # action, or the results of the rules they called when they
+        # don't have one.  Results are kept in the `values' stack until
+        # the rule that called them finishes, and everything else just
+        # recognizes the input without building values.
+        self.actions = actions
+        self.values = []
+        if actions is not None:
+            self.ret = self.retRecognize
+            self.evalClass = self.evalClassRecognize
+            self.evalSequence = self.evalSequenceRecognize
+            self.evalStar = self.evalStarRecognize
+            self.evalPlus = self.evalPlusRecognize
+            self.evalNot = self.evalNotRecognize
+            self.evalAnd = self.evalAndRecognize
+        # Calls to rules go through each of the enabled layers below.
+        # They replace methods, so nothing is checked when they're off
+        self.profile = profile
+        rule = self.evalRuleAction if actions is not None else self.evalIdentifier
+        if incremental:
+            self.memoRule, rule = rule, self.evalIdentifierIncremental
+        elif packrat:
+            self.memoRule, rule = rule, self.evalIdentifierMemo
+        if actions is not None:
+            self.actionRule, rule = rule, self.evalIdentifierAction
+        if profile is not None:
+            self.profiledRule, rule = rule, self.evalIdentifierProfile
+            self.evalExpression = self.evalExpressionProfile
+            self.evalQuestion = self.evalQuestionProfile
+            self.countedStar, self.evalStar = self.evalStar, self.evalStarProfile
+            self.countedNot, self.evalNot = self.evalNot, self.evalNotProfile
+        self.evalIdentifier = rule
 
     def current(self):
-        if self.pos >= len(self.data): return None
-        return self.data[self.pos]
+        # Not using len() because `Stream' doesn't know its size
+        try: return self.data[self.pos]
+        except IndexError: return None
 
     def advance(self, n=1):
-        if self.pos+n >= len(self.data)+1: return None
+        try: self.data[self.pos+n-1]
+        except IndexError: return None
         self.pos += n
         return self.current()
 
+    def currentTracked(self):
+        if self.pos >= self.examined: self.examined = self.pos + 1
+        return Eval.current(self)
+
+    def advanceTracked(self, n=1):
+        if self.pos + n > self.examined: self.examined = self.pos + n
+        return Eval.advance(self, n)
+
     def ret(self, mark):
         return self.data[mark:self.pos] or None
 
+    def retSpan(self, mark):
+        return (mark, self.pos) if self.pos > mark else None
+
     def evalClass(self, atom):
-        d = self.pos
-        value = atom.value
-        if not self.current(): return False, None
-
-        if isinstance(value, list):
-            for [left, right] in value:
-                if left <= self.current() <= right:
-                    value = self.current()
-                    self.advance()
-                    return True, value
-        else:
-            for char in value:
-                if self.current() == char:
-                    value = self.current()
-                    self.advance();
-                    return True, value
+        value = self.current()
+        if value is not None and value in atom.chars:
+            self.advance()
+            return True, value
+        return False, None
+
+    def evalClassSpan(self, atom):
+        value = self.current()
+        if value is not None and value in atom.chars:
+            self.pos += 1
+            return True, (self.pos - 1, self.pos)
         return False, None
 
     def evalLiteral(self, atom):
@@ -401,8 +948,85 @@ class Eval:
             return True, fio(out)
         return False, None
 
+    def isText(self, atom):
+        # Whether the value of `atom' in span mode is either None or
+        # the span of all it matched.  Rules aren't followed, so they
+        # keep their own values
+        if isinstance(atom, (Literal, Class, Dot)): return True
+        elif isinstance(atom, (Question, Star, Plus)): return self.isText(atom.value)
+        elif isinstance(atom, Expression): return all(self.isText(a) for a in atom.value)
+        elif isinstance(atom, Sequence):
+            values = [a for a in atom.value if not isinstance(a, (Not, And))]
+            return len(values) == 1 and self.isText(values[0])
+        return False
+
+    def repeatsText(self, atom):
+        # Cached by the repeated node since `evalPlus()' creates a new
+        # Star around it on each call
+        text = self.textual.get(id(atom.value))
+        if text is None: text = self.textual[id(atom.value)] = self.isText(atom.value)
+        return text
+
+    def evalStarSpan(self, atom):
+        # Repetitions of text become a single span instead of a list
+        # with one span per iteration
+        if not self.repeatsText(atom): return Eval.evalStar(self, atom)
+        d = self.pos
+        while self.evalAtom(atom.value)[0]: pass
+        return True, self.retSpan(d)
+
+    def evalPlusSpan(self, atom):
+        if not self.repeatsText(atom): return Eval.evalPlus(self, atom)
+        d = self.pos
+        if not self.evalAtom(atom.value)[0]: return False, None
+        self.evalStar(atom)
+        return True, self.retSpan(d)
+
+    def retRecognize(self, mark):
+        return True if self.pos > mark else None
+
+    def evalClassRecognize(self, atom):
+        value = self.current()
+        if value is not None and value in atom.chars:
+            self.pos += 1
+            return True, None
+        return False, None
+
+    def evalSequenceRecognize(self, atom):
+        d, mark = self.pos, len(self.values)
+        for sa in atom.value:
+            if not self.evalAtom(sa)[0]:
+                self.pos = d
+                del self.values[mark:]
+                return False, None
+        return True, None
+
+    def evalStarRecognize(self, atom):
+        while self.evalAtom(atom.value)[0]: pass
+        return True, None
+
+    def evalPlusRecognize(self, atom):
+        if not self.evalAtom(atom.value)[0]: return False, None
+        return self.evalStar(atom)
+
+    def evalNotRecognize(self, atom):
+        mark = len(self.values)
+        match, _ = Eval.evalNot(self, atom)
+        del self.values[mark:]
+        return match, None
+
+    def evalAndRecognize(self, atom):
+        mark = len(self.values)
+        match, _ = Eval.evalAnd(self, atom)
+        del self.values[mark:]
+        return match, None
+
     def evalQuestion(self, atom):
+        return True, self.evalAtom(atom.value)[1]
+
+    def evalQuestionProfile(self, atom):
         match, value = self.evalAtom(atom.value)
+        if not match: self.backtracks += 1
         return True, value
 
     def evalStar(self, atom):
@@ -413,6 +1037,11 @@ class Eval:
             out.append(value)
         return True, out
 
+    def evalStarProfile(self, atom):
+        # Repetitions always end with the iteration that failed
+        self.backtracks += 1
+        return self.countedStar(atom)
+
     def evalNot(self, atom):
         d = self.pos
         match, value = self.evalAtom(atom.value)
@@ -421,8 +1050,19 @@ class Eval:
             # position to prior to the evaluation and return None.
             self.pos = d
             return False, None
-        else:
-            return True, None
+        return True, None
+
+    def evalNotProfile(self, atom):
+        match, value = self.countedNot(atom)
+        if match: self.backtracks += 1
+        return match, value
+
+    def evalAnd(self, atom):
+        d = self.pos
+        match, value = self.evalAtom(atom.value)
+        # Predicates never consume input
+        self.pos = d
+        return match, None
 
     def evalSequence(self, atom):
         d = self.pos
@@ -436,16 +1076,121 @@ class Eval:
                 return False, None
         return True, fio(out)
 
+    def candidates(self, atom):
+        dispatch = self.dispatch.get(id(atom))
+        if dispatch is None:
+            if self.analyzer is None: self.analyzer = Analyzer([self.g])
+            dispatch = self.dispatch[id(atom)] = self.analyzer.dispatch(atom)
+        return dispatch.candidates(self.current())
+
     def evalExpression(self, atom):
-        d = self.pos
-        for sa in atom.value:
+        for sa in self.candidates(atom):
             match, value = self.evalAtom(sa)
             if match: return True, value
         return False, None
 
+    def evalExpressionProfile(self, atom):
+        for sa in self.candidates(atom):
+            match, value = self.evalAtom(sa)
+            self.profile.tried(sa, match)
+            if match: return True, value
+            self.backtracks += 1
+        return False, None
+
     def evalIdentifier(self, atom):
         return self.evalAtom(self.g[atom.value])
 
+    def evalIdentifierProfile(self, atom):
+        d, started = self.pos, self.profile.enter(atom.value)
+        match, value = self.profiledRule(atom)
+        self.profile.leave(atom.value, started, match, self.pos - d)
+        return match, value
+
+    def evalIdentifierMemo(self, atom):
+        column = self.memo.get(self.pos)
+        if column is not None and atom.value in column:
+            match, value, self.pos = column[atom.value]
+            return match, value
+        d = self.pos
+        match, value = self.memoRule(atom)
+        self.memoize(d, atom.value, (match, value, self.pos))
+        return match, value
+
+    def evalIdentifierIncremental(self, atom):
+        # Entries are relative to their position, so `edit()' can move
+        # them without touching them
+        d = self.pos
+        column = self.memo.get(d)
+        if column is not None and atom.value in column:
+            match, value, length, examined = column[atom.value]
+            self.pos = d + length
+            if d + examined > self.examined: self.examined = d + examined
+            return match, value
+        outer, self.examined = self.examined, d
+        match, value = self.memoRule(atom)
+        self.memoize(d, atom.value, (match, value, self.pos - d, self.examined - d))
+        if outer > self.examined: self.examined = outer
+        return match, value
+
+    def edit(self, offset, removed, inserted):
+        """Replace `removed' chars at `offset' with `inserted'
+
+        Only for incremental mode.  Memo entries that looked at the
+        changed chars are dropped.  The ones that start after the edit
+        are moved by the change in length, and the ones before it are
+        kept as they are.  The next `run()' parses the new input from
+        the start and only reevaluates rules whose entries were dropped.
+        """
+        end, delta = offset + removed, len(inserted) - removed
+        self.data = self.data[:offset] + inserted + self.data[end:]
+        memo, self.memo = self.memo, {}
+        for pos, column in memo.items():
+            if pos >= end:
+                self.memo[pos + delta] = column
+                continue
+            for name, entry in list(column.items()):
+                # Entries that start in the removed chars are gone even
+                # if they didn't look at them
+                if pos >= offset or pos + entry[3] > offset:
+                    del column[name]
+                    self.memoSize -= 1
+            if column: self.memo[pos] = column
+        self.pos = self.examined = 0
+        self.values = []
+
+    def evalRuleAction(self, atom):
+        # Returns the results to be pushed on the `values' stack, so the
+        # memo can replay them
+        mark, d = len(self.values), self.pos
+        match, _ = self.evalAtom(self.g[atom.value])
+        values = self.values[mark:] if len(self.values) > mark else ()
+        del self.values[mark:]
+        if not match: return False, None
+        action = self.actions.get(atom.value)
+        if action is None: return True, values
+        return True, (action(self.data[d:self.pos], list(values)),)
+
+    def evalIdentifierAction(self, atom):
+        match, values = self.actionRule(atom)
+        if not match: return False, None
+        self.values.extend(values)
+        if atom.value in self.actions: return True, values[0]
+        return True, values
+
+    def memoize(self, pos, name, entry):
+        self.memo.setdefault(pos, {})[name] = entry
+        self.memoSize += 1
+        if self.memoLimit and self.memoSize > self.memoLimit:
+            self.evictMemo()
+
+    def evictMemo(self):
+        # Sliding window: forget the positions that are furthest
+        # behind until half of the table is free again.  Eviction
+        # only costs time if the parser ever backtracks that far.
+        for pos in sorted(self.memo):
+            if self.memoSize <= self.memoLimit // 2: break
+            self.memoSize -= len(self.memo.pop(pos))
+
     def evalAtom(self, atom):
         if isinstance(atom, Class):
             return self.evalClass(atom)
@@ -461,6 +1206,8 @@ class Eval:
             return self.evalStar(atom)
         elif isinstance(atom, Not):
             return self.evalNot(atom)
+        elif isinstance(atom, And):
+            return self.evalAnd(atom)
         elif isinstance(atom, Sequence):
             return self.evalSequence(atom)
         elif isinstance(atom, Expression):
@@ -469,8 +1216,309 @@ class Eval:
             return self.evalQuestion(atom)
         raise Exception('Unexpected atom')
 
+    def evalStream(self, atom):
+        out = list(self.iterate())
+        if isinstance(atom, Star): return True, out
+        elif out: return True, fio(out)
+        return False, None
+
+    def iterate(self):
+        """Yield the value of each iteration of the start rule
+
+        The start rule must be a Star or a Plus.  Each value is yielded
+        as soon as its iteration matches, so the whole output is never
+        held in memory.  Iteration stops at the first failure and `pos'
+        is left at the first char that wasn't consumed.
+        """
+        atom = self.g[self.start]
+        if not isinstance(atom, (Star, Plus)):
+            raise Exception("Rule %s is not a repetition" % self.start)
+        while True:
+            match, value = self.evalAtom(atom.value)
+            if not match: break
+            if self.actions is not None:
+                value, self.values = fio(self.values), []
+            # Nothing before the end of an iteration of the top level
+            # repetition can be backtracked into, so that input and the
+            # memo entries that start in it are released
+            if isinstance(self.data, Stream): self.data.release(self.pos)
+            for pos in [p for p in self.memo if p < self.pos]:
+                self.memoSize -= len(self.memo.pop(pos))
+            yield value
+
     def run(self):
-        return self.evalAtom(self.g[self.start])
+        atom = self.g[self.start]
+        if (isinstance(self.data, Stream) and isinstance(atom, (Star, Plus)) and
+                self.start not in (self.actions or ())):
+            return self.evalStream(atom)
+        match, value = self.evalIdentifier(Identifier(self.start))
+        if self.actions is not None and self.start not in self.actions:
+            value = list(value) if match else None
+        # The memo keeps the values for the next run, so changes to
+        # the output must not reach them
+        if self.incremental: value = copyLists(value)
+        return match, value
+
+
+class ClosureCompiler:
+
+    """Turn the grammar into a graph of Python closures
+
+    The `isinstance' dispatch of `Eval' happens only once per node,
+    when the grammar is compiled.  Each closure takes the input and a
+    position and returns either the tuple `(position, value)' after
+    matching or None when the match fails.  Values are the same ones
+    `Eval' produces, so both engines are interchangeable.
+    """
+
+    def __init__(self, grammar, profile=None, analyzer=None):
+        self.g = mergeDicts(grammar)
+        self.analyzer = analyzer or Analyzer(grammar)
+        # Profiling wraps the closures of rules and alternatives, so
+        # the ones compiled without it don't change
+        self.profile = profile
+        self.rules = {}
+        # Bodies of repetitions, compiled by `iterate()' when needed
+        self.bodies = {}
+        for name, atom in self.g.items():
+            self.rules[name] = self.compileAtom(atom)
+            if profile is not None:
+                self.rules[name] = self.profileRule(name, self.rules[name])
+
+    def profileRule(self, name, p):
+        profile = self.profile
+        def matchProfile(s, i):
+            started = profile.enter(name)
+            r = p(s, i)
+            profile.leave(name, started, r is not None, r[0] - i if r else 0)
+            return r
+        return matchProfile
+
+    def profileAlternative(self, atom, p):
+        tried = self.profile.tried
+        def matchProfile(s, i):
+            r = p(s, i)
+            tried(atom, r is not None)
+            return r
+        return matchProfile
+
+    def compileClass(self, atom):
+        chars, table = atom.chars, atom.chars.table
+        def matchClass(s, i):
+            try: c = s[i]
+            except IndexError: return None
+            o = ord(c)
+            if table[o] if o <= 0xff else c in chars: return i + 1, c
+            return None
+        return matchClass
+
+    def compileLiteral(self, atom):
+        value, size = atom.value, len(atom.value)
+        def matchLiteral(s, i):
+            if s.startswith(value, i): return i + size, value
+            return None
+        return matchLiteral
+
+    def compileDot(self, atom):
+        def matchDot(s, i):
+            try: return i + 1, s[i]
+            except IndexError: return None
+        return matchDot
+
+    def compileIdentifier(self, atom):
+        # Rules are looked up when called because they might not have
+        # been compiled yet (or might be recursive)
+        rules, name = self.rules, atom.value
+        def matchIdentifier(s, i):
+            return rules[name](s, i)
+        return matchIdentifier
+
+    def compileNot(self, atom):
+        p = self.compileAtom(atom.value)
+        def matchNot(s, i):
+            if p(s, i) is None: return i, None
+            return None
+        return matchNot
+
+    def compileAnd(self, atom):
+        p = self.compileAtom(atom.value)
+        def matchAnd(s, i):
+            if p(s, i) is None: return None
+            return i, None
+        return matchAnd
+
+    def compileQuestion(self, atom):
+        p = self.compileAtom(atom.value)
+        def matchQuestion(s, i):
+            return p(s, i) or (i, None)
+        return matchQuestion
+
+    def compileStar(self, atom):
+        p = self.compileAtom(atom.value)
+        def matchStar(s, i):
+            out = []
+            while True:
+                r = p(s, i)
+                if r is None: return i, out
+                i, value = r
+                out.append(value)
+        return matchStar
+
+    def compilePlus(self, atom):
+        p = self.compileAtom(atom.value)
+        def matchPlus(s, i):
+            r = p(s, i)
+            if r is None: return None
+            i, value = r
+            out = [value]
+            while True:
+                r = p(s, i)
+                if r is None: return i, fio(out)
+                i, value = r
+                out.append(value)
+        return matchPlus
+
+    def compileSequence(self, atom):
+        ps = [self.compileAtom(a) for a in atom.value]
+        def matchSequence(s, i):
+            out = []
+            for p in ps:
+                r = p(s, i)
+                if r is None: return None
+                i, value = r
+                if value: out.append(value)
+            return i, fio(out)
+        return matchSequence
+
+    def compileExpression(self, atom):
+        ps = [self.compileAtom(a) for a in atom.value]
+        if self.profile is not None:
+            ps = [self.profileAlternative(a, p) for a, p in zip(atom.value, ps)]
+        candidates = self.analyzer.dispatch(atom, ps).candidates
+        def matchExpression(s, i):
+            try: c = s[i]
+            except IndexError: c = None
+            for p in candidates(c):
+                r = p(s, i)
+                if r is not None: return r
+            return None
+        return matchExpression
+
+    def compileAtom(self, atom):
+        if isinstance(atom, Class): return self.compileClass(atom)
+        elif isinstance(atom, Literal): return self.compileLiteral(atom)
+        elif isinstance(atom, Dot): return self.compileDot(atom)
+        elif isinstance(atom, Identifier): return self.compileIdentifier(atom)
+        elif isinstance(atom, Plus): return self.compilePlus(atom)
+        elif isinstance(atom, Star): return self.compileStar(atom)
+        elif isinstance(atom, Not): return self.compileNot(atom)
+        elif isinstance(atom, And): return self.compileAnd(atom)
+        elif isinstance(atom, Sequence): return self.compileSequence(atom)
+        elif isinstance(atom, Expression): return self.compileExpression(atom)
+        elif isinstance(atom, Question): return self.compileQuestion(atom)
+        raise Exception('Unexpected atom')
+
+    def match(self, start, data, pos=0):
+        return self.rules[start](data, pos)
+
+    def matchStream(self, start, data):
+        # Same as `Eval.evalStream()'
+        i, out = 0, []
+        for i, value in self.iterate(start, data):
+            out.append(value)
+        if isinstance(self.g[start], Star): return i, out
+        elif out: return i, fio(out)
+        return None
+
+    def body(self, start):
+        """Closure of one iteration of `start', compiled once"""
+        p = self.bodies.get(start)
+        if p is None:
+            atom = self.g[start]
+            if not isinstance(atom, (Star, Plus)):
+                raise Exception("Rule %s is not a repetition" % start)
+            p = self.bodies[start] = self.compileAtom(atom.value)
+        return p
+
+    def iterate(self, start, data, pos=0):
+        """Yield `(position, value)' for each iteration of `start'
+
+        Same as `Eval.iterate()', but the position after each match is
+        yielded along with its value since closures don't keep state.
+        """
+        p, i = self.body(start), pos
+        while True:
+            r = p(data, i)
+            if r is None: break
+            i = r[0]
+            if isinstance(data, Stream): data.release(i)
+            yield r
+
+    def run(self, start, data):
+        if isinstance(data, Stream) and isinstance(self.g[start], (Star, Plus)):
+            r = self.matchStream(start, data)
+        else:
+            r = self.match(start, data)
+        if r is None: return False, None
+        return True, r[1]
+
+
+# Compiled once by each process of the pool in `parallel()'
+_worker = None
+
+
+def _initWorker(grammar, start):
+    global _worker
+    _worker = ClosureCompiler(grammar)
+    _worker.body(start)
+
+
+def _parseChunk(start, chunk):
+    i, out = 0, []
+    for i, value in _worker.iterate(start, chunk):
+        out.append(value)
+    return i, out
+
+
+def splitRecords(data, size, separator='\n'):
+    """Cut `data' in chunks of about `size' chars ending in `separator'"""
+    chunks, start = [], 0
+    while start < len(data):
+        end = data.find(separator, start + size)
+        end = len(data) if end < 0 else end + len(separator)
+        chunks.append(data[start:end])
+        start = end
+    return chunks
+
+
+def parallel(grammar, start, data, workers=None, chunkSize=1 << 20,
+             separator='\n'):
+    """Parse `data' with a pool of processes
+
+    The start rule must be a repetition whose iterations never cross a
+    `separator', which is true for line oriented grammars like `csv'.
+    The input is split at separators, each process matches the
+    iterations of `start' within its chunks and the values are joined
+    back in order.  Raises SyntaxError with the line of the input where
+    the first chunk that doesn't match stopped.
+    """
+    g = mergeDicts(grammar)
+    if not isinstance(g[start], (Star, Plus)):
+        raise Exception("Rule %s is not a repetition" % start)
+    chunks = splitRecords(data, chunkSize, separator)
+    out, line = [], 1
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_initWorker, initargs=(grammar, start)) as pool:
+        results = pool.map(_parseChunk, [start] * len(chunks), chunks)
+        for chunk, (end, values) in zip(chunks, results):
+            if end < len(chunk):
+                line += chunk.count('\n', 0, end)
+                raise SyntaxError("Failed to match %s at line %d" % (start, line))
+            line += chunk.count('\n')
+            out.extend(values)
+    if isinstance(g[start], Plus) and not out:
+        raise SyntaxError("Failed to match %s at line %d" % (start, line))
+    return True, out
 
 
 class Instructions(enum.Enum):
@@ -488,23 +1536,55 @@ class Instructions(enum.Enum):
      OP_JUMP,
      OP_CALL,
      OP_RETURN,
+     OP_SET,
+     OP_SPAN,
      OP_END,
-    ) = range(15)
+    ) = range(17)
+
+# Plain ints for the machine loop, enum lookups are too slow there
+(OP_HALT,
+ OP_CHAR,
+ OP_ANY,
+ OP_CHOICE,
+ OP_COMMIT,
+ OP_FAIL,
+ OP_FAIL_TWICE,
+ OP_PARTIAL_COMMIT,
+ OP_BACK_COMMIT,
+ OP_TEST_CHAR,
+ OP_TEST_ANY,
+ OP_JUMP,
+ OP_CALL,
+ OP_RETURN,
+ OP_SET,
+ OP_SPAN,
+ OP_END,
+) = [i.value for i in Instructions]
 
 
 class Compiler:
 
-    def __init__(self, grammar):
-        self.g = {x: y for di in grammar for x, y in di.items()}
-        self.start = grammar[0].keys()[0]
+    def __init__(self, grammar, start=None, optimize=True, analyzer=None):
+        self.g = mergeDicts(grammar)
+        self.start = start or next(iter(grammar[0]))
+        # Use TestChar, TestAny, Set & Span when possible instead of
+        # the plain instructions from the original parsing machine
+        self.optimize = optimize
+        self.analyzer = analyzer or Analyzer(grammar)
         self.pos = 0
         self.code = []
+        # Address of the first instruction of each rule. Calls are
+        # patched with these addresses after all rules are compiled
+        # because a rule can be called before it is emitted.
+        self.rules = {}
+        self.calls = []
 
     def gen(self, instruction, arg0=None, arg1=None):
         if arg0 is not None and arg1 is not None: # Two 14bit args
-            raise NotImplementedError("I owe you two parameters!")
+            return (((arg0 & 0x3fff) << 14) | (arg1 & 0x3fff) |
+                    (instruction.value << 28))
         elif arg0 is not None and arg1 is None: # Single 28bits arg
-            return (arg0 & 0x00ffffff) | (instruction.value << 28)
+            return (arg0 & 0x0fffffff) | (instruction.value << 28)
         elif arg0 is None and arg1 is not None: # Not supported
             raise Exception("Plz use arg0 instead of arg1")
         else:                  # No arguments. Just padding with zeros
@@ -515,22 +1595,60 @@ class Compiler:
         self.pos += 1
         return self.pos
 
+    def emitSet(self, instruction, words):
+        self.emit(instruction)
+        self.code.extend(words)
+        self.pos += len(words)
+        return self.pos
+
+    def charset(self, atom):
+        # The 256 bit set used by Set & Span as 8 words. Only classes
+        # and single char literals can become sets and only if all
+        # their chars fit in it.
+        if isinstance(atom, Literal) and len(atom.value) == 1:
+            chars = CharSet(atom.value)
+        elif isinstance(atom, Class):
+            chars = atom.chars
+        else:
+            return None
+        if chars.lefts: return None
+        words = [0] * 8
+        for c, member in enumerate(chars.table):
+            if member: words[c >> 5] |= 1 << (c & 31)
+        return words
+
     def cc(self, atom):
         currentPos = self.pos
         self.compileAtom(atom)
         programSize = self.pos - currentPos
         return programSize
 
-    def invariant(self, program):
-        # It's always 2 because invariant contains two instructions
+    def invariant(self):
+        # Call the start rule and jump over the other rules to the
+        # Halt instruction once it returns. The Jump is absolute.
         self.emit(Instructions.OP_CALL, 2)
         pos = self.emit(Instructions.OP_JUMP)
-        size = self.cc(program)
-        self.code[pos-1] = self.gen(Instructions.OP_JUMP, size + 3)
-        self.emit(Instructions.OP_RETURN)
+        self.compileRule(self.start)
+        for name in self.g:
+            if name != self.start: self.compileRule(name)
+        self.code[pos-1] = self.gen(Instructions.OP_JUMP, self.pos)
         self.emit(Instructions.OP_HALT)
+        for pos, name in self.calls:
+            if name not in self.rules:
+                raise Exception("Unknown rule %s" % name)
+            self.code[pos] = self.gen(Instructions.OP_CALL, self.rules[name] - pos)
+
+    def compileRule(self, name):
+        self.rules[name] = self.pos
+        self.compileAtom(self.g[name])
+        self.emit(Instructions.OP_RETURN)
 
     def compileNot(self, atom):
+        if self.optimize and isinstance(atom.value, Dot):
+            # TestAny 2 1; Fail
+            self.emit(Instructions.OP_TEST_ANY, 2, 1)
+            self.emit(Instructions.OP_FAIL)
+            return
         pos = self.emit(Instructions.OP_CHOICE)
         size = self.cc(atom.value)
         self.code[pos-1] = self.gen(Instructions.OP_CHOICE, size + 3)
@@ -551,35 +1669,368 @@ class Compiler:
         for i in literal.value:
             self.emit(Instructions.OP_CHAR, ord(i))
 
+    def compileClass(self, atom):
+        # Each char of the class becomes an alternative of an ordered
+        # choice. Ranges are expanded to all the chars they contain.
+        words = self.charset(atom) if self.optimize else None
+        if words is not None:
+            self.emitSet(Instructions.OP_SET, words)
+            return
+        chars = atom.value
+        if isinstance(chars, list):
+            chars = [chr(c) for [left, right] in chars
+                     for c in range(ord(left), ord(right) + 1)]
+        if not chars: self.emit(Instructions.OP_FAIL)
+        else: self.compileChoices([Literal(c) for c in chars])
+
     def compileSequence(self, sequence):
         for atom in sequence.value:
             self.compileAtom(atom)
 
+    def compileChoices(self, atoms):
+        # Choice L1; p1; Commit L; L1: Choice L2; p2; Commit L; ... pn; L:
+        #
+        # When an alternative can only start with one char, according
+        # to its FIRST set, it's also guarded with `TestChar L1 c', so
+        # it's skipped without pushing a backtrack entry when the
+        # current char isn't `c'.
+        commits = []
+        for atom in atoms[:-1]:
+            test = None
+            first = self.analyzer.onlyChar(atom) if self.optimize else None
+            if first is not None and ord(first) <= 0x3fff:
+                test = self.emit(Instructions.OP_TEST_CHAR, 1, ord(first)) - 1
+            choice = self.emit(Instructions.OP_CHOICE) - 1
+            self.compileAtom(atom)
+            commits.append(self.emit(Instructions.OP_COMMIT) - 1)
+            self.code[choice] = self.gen(Instructions.OP_CHOICE, self.pos - choice)
+            # Offsets that don't fit in 14bits leave the no-op `TestChar 1 c'
+            if test is not None and self.pos - test < 0x2000:
+                self.code[test] = self.gen(Instructions.OP_TEST_CHAR, self.pos - test, ord(first))
+        self.compileAtom(atoms[-1])
+        for commit in commits:
+            self.code[commit] = self.gen(Instructions.OP_COMMIT, self.pos - commit)
+
     def compileExpression(self, expr):
-        it = len(expr.value)
-        for atom in expr.value:
-            print("EXPR %s [%d]" % (atom, it))
-            self.emit(Instructions.OP_CHOICE)
-            locationCell = self.pos-1 # Argument to instruction above
-            programSize = self._compileAtomAndGetSize(atom)
-            self.code[locationCell] = programSize + it
-            self.emit(Instructions.OP_COMMIT)
-            it -= 1
+        self.compileChoices(expr.value)
+
+    def compileStar(self, atom):
+        words = self.charset(atom.value) if self.optimize else None
+        if words is not None:
+            self.emitSet(Instructions.OP_SPAN, words)
+            return
+        # Choice L2; L1: p; PartialCommit L1; L2:
+        choice = self.emit(Instructions.OP_CHOICE) - 1
+        body = self.pos
+        self.compileAtom(atom.value)
+        self.emit(Instructions.OP_PARTIAL_COMMIT, body - self.pos)
+        self.code[choice] = self.gen(Instructions.OP_CHOICE, self.pos - choice)
+
+    def compilePlus(self, atom):
+        self.compileAtom(atom.value)
+        self.compileStar(atom)
+
+    def compileQuestion(self, atom):
+        # Choice L; p; Commit 1; L:
+        choice = self.emit(Instructions.OP_CHOICE) - 1
+        self.compileAtom(atom.value)
+        self.emit(Instructions.OP_COMMIT, 1)
+        self.code[choice] = self.gen(Instructions.OP_CHOICE, self.pos - choice)
+
+    def compileIdentifier(self, atom):
+        # The offset is filled in by `invariant()' once all the rules
+        # have their addresses
+        self.calls.append((self.pos, atom.value))
+        self.emit(Instructions.OP_CALL, 0)
 
     def compileAtom(self, atom):
         if isinstance(atom, Literal): self.compileLiteral(atom)
         elif isinstance(atom, Dot): self.emit(Instructions.OP_ANY)
+        elif isinstance(atom, Class): self.compileClass(atom)
+        elif isinstance(atom, Identifier): self.compileIdentifier(atom)
         elif isinstance(atom, Not): self.compileNot(atom)
         elif isinstance(atom, And): self.compileAnd(atom)
+        elif isinstance(atom, Star): self.compileStar(atom)
+        elif isinstance(atom, Plus): self.compilePlus(atom)
+        elif isinstance(atom, Question): self.compileQuestion(atom)
         elif isinstance(atom, Sequence): self.compileSequence(atom)
         elif isinstance(atom, Expression): self.compileExpression(atom)
         else: raise Exception("Unknown atom %s" % atom)
 
     def run(self):
-        self.invariant(self.g[self.start])
+        self.invariant()
         return struct.pack('>' + ('I' * len(self.code)), *self.code)
 
 
+class Machine:
+
+    """Parsing machine that runs the bytecode emitted by `Compiler'
+
+    Follows `mEval()' from vm.c: the program is a flat array of 32bit
+    instructions and backtracking is done with an explicit stack of
+    `(position, pc)' entries instead of recursion.  Call frames are
+    pushed with position None so failures skip them.  The input can
+    be a `str' or anything that yields integers when indexed (bytes,
+    bytearray, mmap, memoryview).
+    """
+
+    def __init__(self, bytecode, profile=False):
+        self.code = array.array('I')
+        self.code.frombytes(bytecode)
+        if sys.byteorder == 'little': self.code.byteswap()
+        # Failures that popped a choice point off the stack.  Only
+        # counted when profiling
+        self.profile = profile
+        self.backtracks = 0
+
+    def match(self, data, pos=0):
+        if isinstance(data, str):
+            # Index code points as integers, like the bytes in vm.c
+            data = memoryview(data.encode('utf-32-' + sys.byteorder[0] + 'e')).cast('I')
+        code, size, stack, profile = self.code, len(data), [], self.profile
+        pc, i = 0, pos
+        while True:
+            instr = code[pc]
+            op, arg = instr >> 28, instr & 0x0fffffff
+            if arg & 0x08000000: arg -= 0x10000000
+            if op == OP_CHAR:
+                if i < size and data[i] == arg:
+                    i += 1; pc += 1
+                    continue
+            elif op == OP_ANY:
+                if i < size:
+                    i += 1; pc += 1
+                    continue
+            elif op == OP_SET:
+                if i < size and data[i] < 256 and code[pc + 1 + (data[i] >> 5)] >> (data[i] & 31) & 1:
+                    i += 1; pc += 9
+                    continue
+            elif op == OP_SPAN:
+                while i < size and data[i] < 256 and code[pc + 1 + (data[i] >> 5)] >> (data[i] & 31) & 1:
+                    i += 1
+                pc += 9
+                continue
+            elif op == OP_TEST_CHAR or op == OP_TEST_ANY:
+                offset, arg = arg >> 14 & 0x3fff, arg & 0x3fff
+                if offset & 0x2000: offset -= 0x4000
+                if op == OP_TEST_CHAR: ok = i < size and data[i] == arg
+                else: ok = size - i >= arg
+                pc += 1 if ok else offset
+                continue
+            elif op == OP_CHOICE:
+                stack.append((i, pc + arg)); pc += 1
+                continue
+            elif op == OP_COMMIT:
+                stack.pop(); pc += arg
+                continue
+            elif op == OP_PARTIAL_COMMIT:
+                stack[-1] = (i, stack[-1][1]); pc += arg
+                continue
+            elif op == OP_BACK_COMMIT:
+                i = stack.pop()[0]; pc += arg
+                continue
+            elif op == OP_JUMP:
+                pc = arg
+                continue
+            elif op == OP_CALL:
+                stack.append((None, pc + 1)); pc += arg
+                continue
+            elif op == OP_RETURN:
+                pc = stack.pop()[1]
+                continue
+            elif op == OP_HALT:
+                return i
+            elif op == OP_FAIL_TWICE:
+                stack.pop()
+            elif op != OP_FAIL:
+                raise Exception("Unknown instruction 0x%08x" % instr)
+            # Fail: Unwind the stack until the last choice point. The
+            # match fails when there isn't one.
+            while stack:
+                i, pc = stack.pop()
+                if i is not None: break
+            else:
+                return None
+            if profile: self.backtracks += 1
+
+    def run(self, data):
+        end = self.match(data)
+        return end is not None, end
+
+
+class CMachine:
+
+    """Drive the parsing machine from vm.c in-process
+
+    vm.c is built as a shared library with `make libvm.so' the first
+    time it's needed.  The program is loaded once with `mRead()' and
+    each call to `match()' just points the machine to the new input
+    with `mInput()'.  `bytes' and writable buffers (bytearray, mmap,
+    array) are handed to the machine without copying, each byte is a
+    char.  Other read-only buffers are copied.  `str' inputs are
+    matched by code point: they're encoded as latin-1 when they fit
+    and as UTF-32 otherwise, so positions don't change either way.
+    Errors of the machine, like running out of memory for its stack,
+    are raised as exceptions.
+    """
+
+    library = None
+
+    @classmethod
+    def load(cls):
+        if cls.library is None:
+            here = os.path.dirname(os.path.abspath(__file__))
+            subprocess.check_call(['make', '-s', '-C', here, 'libvm.so'])
+            lib = ctypes.CDLL(os.path.join(here, 'libvm.so'))
+            lib.mSizeOf.restype = ctypes.c_size_t
+            lib.mInit.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+            lib.mInput.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+            lib.mError.argtypes = [ctypes.c_void_p]
+            lib.mError.restype = ctypes.c_char_p
+            lib.mRead.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t]
+            lib.mEval.argtypes = [ctypes.c_void_p]
+            lib.mEval.restype = ctypes.c_void_p
+            lib.mFree.argtypes = [ctypes.c_void_p]
+            cls.library = lib
+        return cls.library
+
+    def __init__(self, bytecode):
+        self.lib = self.load()
+        self.m = ctypes.create_string_buffer(self.lib.mSizeOf())
+        self.lib.mInit(self.m, None, 0)
+        self.lib.mRead(self.m, bytecode, len(bytecode))
+        self.check()
+
+    def __del__(self):
+        if getattr(self, 'm', None) is not None:
+            self.lib.mFree(self.m)
+            self.m = None
+
+    def check(self):
+        error = self.lib.mError(self.m)
+        if error: raise Exception(error.decode('utf-8'))
+
+    def match(self, data, pos=0):
+        width = 1
+        if isinstance(data, str):
+            try:
+                data = data.encode('latin-1')
+            except UnicodeEncodeError:
+                data, width = data.encode('utf-32-le' if sys.byteorder == 'little' else 'utf-32-be'), 4
+        if isinstance(data, bytes):
+            address = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+            size = len(data)
+        else:
+            view = memoryview(data)
+            try:
+                buf = (ctypes.c_char * view.nbytes).from_buffer(view)
+            except TypeError:
+                # Read-only buffers can't be shared with ctypes
+                return self.match(view.tobytes(), pos)
+            address, size = ctypes.addressof(buf), view.nbytes
+        # mInput() takes the size unsigned, positions past the end
+        # would let the machine read past the input
+        if not 0 <= pos * width <= size:
+            raise ValueError("Position %d is outside of the input" % pos)
+        self.lib.mInput(self.m, address + pos * width, size - pos * width, width)
+        end = self.lib.mEval(self.m)
+        self.check()
+        if end is None: return None
+        return (end - address) // width
+
+    def run(self, data):
+        end = self.match(data)
+        return end is not None, end
+
+
+@functools.lru_cache()
+def engineDigest():
+    "Hash of this file, part of the key of the `GrammarCache' entries"
+    with io.open(os.path.abspath(__file__), 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+class GrammarCache:
+
+    """Parsed grammars and their bytecode saved next to the grammar
+
+    Like `__pycache__', entries live in a `__pegcache__' directory in
+    the same directory as the grammar file.  Each entry is keyed by a
+    hash of the contents of the grammar and of this file, so editing
+    either is enough to invalidate it.  Grammars are only saved after
+    they pass the checks of `Analyzer', which then don't run again on
+    a hit.  Unpickling can run code, so entries are only read when
+    they and their directory belong to the current user and nobody
+    else can write to them.  Failing to read or write the cache is
+    never an error, the grammar is just parsed again.
+    """
+
+    def __init__(self, path, enabled=True):
+        with io.open(path, 'rb') as grammarFile:
+            self.source = grammarFile.read()
+        self.digest = hashlib.sha256(engineDigest() + self.source).hexdigest()
+        directory, name = os.path.split(os.path.abspath(path))
+        self.path = os.path.join(directory, '__pegcache__', name + '.pickle')
+        self.enabled = enabled
+        self.entry = self.read() if enabled else None
+        self.hit = self.entry is not None
+        # Not saved, it's only built on a hit when something needs it
+        self.analysis = None
+        if self.entry is None:
+            grammar = Parser(self.source.decode('utf-8')).run()
+            self.analysis = Analyzer(grammar).check()
+            self.entry = {'digest': self.digest, 'grammar': grammar, 'bytecode': {}}
+            self.write()
+
+    @staticmethod
+    def trusted(st):
+        if hasattr(os, 'getuid') and st.st_uid != os.getuid(): return False
+        return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+    def read(self):
+        try:
+            if not self.trusted(os.lstat(os.path.dirname(self.path))): return None
+            with io.open(self.path, 'rb') as cacheFile:
+                st = os.fstat(cacheFile.fileno())
+                if not stat.S_ISREG(st.st_mode) or not self.trusted(st): return None
+                entry = pickle.load(cacheFile)
+        except Exception:
+            return None
+        if not isinstance(entry, dict) or entry.get('digest') != self.digest:
+            return None
+        return entry
+
+    def write(self):
+        if not self.enabled: return
+        # Written to a temporary file first so concurrent runs never
+        # see half of an entry
+        out = None
+        try:
+            os.makedirs(os.path.dirname(self.path), mode=0o755, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    dir=os.path.dirname(self.path), delete=False) as out:
+                pickle.dump(self.entry, out, pickle.HIGHEST_PROTOCOL)
+            os.replace(out.name, self.path)
+        except Exception:
+            if out is not None:
+                try: os.unlink(out.name)
+                except OSError: pass
+
+    def grammar(self):
+        return self.entry['grammar']
+
+    def analyzer(self):
+        if self.analysis is None: self.analysis = Analyzer(self.grammar())
+        return self.analysis
+
+    def bytecode(self, start=None):
+        bytecode = self.entry['bytecode']
+        if start not in bytecode:
+            bytecode[start] = Compiler(self.grammar(), start, analyzer=self.analyzer()).run()
+            self.write()
+        return bytecode[start]
+
+
 ## --- tests ---
 
 csv = r'''
@@ -685,6 +2136,8 @@ def test_parser():
 
     test('Int <- [0-9]+', [{'Int': Plus(Class([['0', '9']]))}])
 
+    test('Id <- [a-z_]', [{'Id': Class([['a', 'z'], ['_', '_']])}])
+
     test('EndOfFile <- !.', [{'EndOfFile': Not(Dot())}])
 
     test('R0 <- "oi" "tenta"?', [{'R0': Sequence([Literal('oi'), Question(Literal("tenta"))])}])
@@ -751,6 +2204,31 @@ EndOfFile  <- !.
         {'Num': Plus(Class([['0', '9']]))}])
 
 
+def test_parser_deep():
+    # Nesting and the number of rules aren't limited by the stack
+    depth = sys.getrecursionlimit() * 2
+    grammar = Parser('A <- ' + '(' * depth + "'a'" + ')*' * depth).parse()
+    atom = grammar[0]['A']
+    for _ in range(depth): atom = atom.value
+    assert(atom == Literal('a'))
+
+    rules = 5000
+    source = '\n'.join('R%d <- R%d / [0-9]' % (i, i + 1) for i in range(rules))
+    grammar = Parser(source + '\nR%d <- "."' % rules).parse()
+    assert(len(grammar) == rules + 1)
+    assert(grammar[0] == {'R0': Expression([Identifier('R1'), Class([['0', '9']])])})
+
+    # Consecutive comments and empty lines
+    assert(Parser('# a\n# b\n\n# c\nX <- .  # d\n# e\n').parse() == [{'X': Dot()}])
+
+    for source, message in [("X <- 'a", "Expected end of string"),
+                            ('X <- [a-', "Expected end of class"),
+                            ("X <- '\\q'", "Unknown escape char `q`"),
+                            ("X <- ('a'", "Expected CLOSE but found END")]:
+        raised, value = _safe_from_error(Parser(source))
+        assert(raised and str(value) == message), (source, value)
+
+
 def _safe_from_error(p):
     raised = False
     value = None
@@ -879,6 +2357,600 @@ C <- [a-z]+
     assert(e.evalAtom(Identifier('C')) == (True, '\t'))
 
 
+def test_charset():
+    chars = CharSet([['a', 'f'], ['0', '9'], ['_', '_'], ['α', 'γ'], ['β', 'ε'], ['ж', 'ж']])
+    assert([c in chars for c in 'af09_']                == [True] * 5)
+    assert([c in chars for c in 'gA/:`']                == [False] * 5)
+    assert([c in chars for c in 'αβγδεж']              == [True] * 6)
+    assert([c in chars for c in 'ζзё\u00ff\U0001f600'] == [False] * 5)
+    assert((chars.lefts, chars.rights) == ([ord('α'), ord('ж')], [ord('ε'), ord('ж')]))
+    assert('b' in CharSet('abc') and 'd' not in CharSet('abc'))
+
+    e = Eval(Parser('Id <- [a-zA-Z_ä]+').parse(), 'Id', "fooBar_ä1")
+    assert(e.run() == (True, ['f', 'o', 'o', 'B', 'a', 'r', '_', 'ä']))
+
+
+def test_slots():
+    g = Parser(csv).parse()
+    for node in Analyzer(g).walk(mergeDicts(g)['CSV']):
+        assert(not hasattr(node, '__dict__'))
+    assert(not hasattr(Token(TokenTypes.DOT), '__dict__'))
+    assert(not hasattr(Class('a').chars, '__dict__'))
+    # Same values, reprs and equality as before
+    assert(Token(TokenTypes.DOT, line=1) == Token(TokenTypes.DOT, line=1))
+    assert(Token(TokenTypes.DOT, line=1) != Token(TokenTypes.DOT, line=2))
+    assert(repr(Sequence([Identifier('Val'), Star(Dot())])) ==
+           "Sequence([Identifier('Val'), Star(Dot())])")
+    assert(Class([['a', 'c']]) == Class([['a', 'c']])); assert(Class('a') != Literal('a'))
+    assert(pickle.loads(pickle.dumps(g)) == g)
+    assert('b' in pickle.loads(pickle.dumps(Class([['a', 'c']]))).chars)
+
+
+def test_analyzer():
+    a = Analyzer(Parser(csv).parse())
+    assert(a.nullables == {'File': True, 'CSV': False, 'Val': True})
+    assert(a.firsts['CSV'] == None)
+    assert(a.errors() == [])
+
+    a = Analyzer(Parser(arith).parse())
+    assert(not any(a.nullables.values()))
+    assert(a.firsts['Num'] == {(ord('0'), ord('9'))})
+    assert(a.firsts['Add'] == a.firsts['Pri'] == {(ord('('), ord('(')), (ord('0'), ord('9'))})
+    assert('7' in a.first(a.g['Add'])); assert('+' not in a.first(a.g['Add']))
+    assert(a.check() is a)
+
+    with io.open(os.path.join(os.path.dirname(__file__), 'peg.g')) as f:
+        a = Analyzer(Parser(f.read()).parse())
+    assert(a.errors() == [])
+    assert(a.nullables['Spacing'] and a.nullables['Sequence'])
+    assert(a.firsts['Identifier'] == {(ord('a'), ord('z')), (ord('A'), ord('Z')), (ord('_'), ord('_'))})
+
+    # Predicates are skipped, whatever follows them starts the match
+    a = Analyzer(Parser("A <- !'x' &'y' 'b'? 'c'").parse())
+    assert(not a.nullables['A'])
+    assert(a.firsts['A'] == {(ord('b'), ord('b')), (ord('c'), ord('c'))})
+
+    a = Analyzer(Parser("""
+A <- B 'x' / 'a'
+B <- 'b'? A
+C <- C2* 'c'
+C2 <- 'c'? !'d'
+D <- 'd' D / E
+""").parse())
+    assert(a.errors() == [
+        "Rule A is left recursive",
+        "Rule B is left recursive",
+        "Rule C repeats an expression that matches the empty string",
+        "Rule D uses unknown rule E",
+    ])
+    raised = None
+    try: a.check()
+    except Exception as exc: raised = str(exc)
+    assert(raised.splitlines()[0] == "Rule A is left recursive")
+
+
+def test_dispatch():
+    g = Parser("""
+Stmt <- 'if' / 'import' / 'while' / Name / Num / '!'?
+Name <- [a-zé]+
+Num  <- [0-9]+
+""").parse()
+    a = Analyzer(g)
+    [ifs, imports, whiles, name, num, empty] = a.g['Stmt'].value
+    d = a.dispatch(a.g['Stmt'])
+    # Candidates keep the order of the choice
+    assert(d.candidates('i') == (ifs, imports, name, empty))
+    assert(d.candidates('w') == (whiles, name, empty))
+    assert(d.candidates('7') == (num, empty))
+    assert(d.candidates('+') == (empty,))
+    assert(d.candidates(None) == (empty,))
+    assert(d.candidates('é') == (name, empty))
+    assert(d.candidates('ü') == (empty,))
+    assert(d.candidates('\u0100') == [empty])
+    assert(d.candidates('j') is d.candidates('k'))
+    assert(a.dispatch(a.g['Stmt'], range(6)).candidates('w') == (2, 3, 5))
+
+    for data, expected in [("if", 'if'), ("while", 'while'),
+                           ("xy", ['x', 'y']), ("42", ['4', '2']), ("+", None)]:
+        assert(Eval(g, 'Stmt', data).run() == (True, expected))
+        assert(ClosureCompiler(g).run('Stmt', data) == (True, expected))
+
+    # Alternatives that start with a single char after a predicate
+    # get a TestChar guard too
+    assert(Analyzer(Parser("A <- !'x' 'a' / 'b'").parse()).onlyChar(
+        Parser("A <- !'x' 'a'").parse()[0]['A']) == 'a')
+    program = Compiler(Parser("A <- !'x' 'a' / 'b'").parse()).run()
+    ops = [op >> 28 for op in struct.unpack('>%dI' % (len(program) // 4), program)]
+    assert(OP_TEST_CHAR in ops)
+    m = Machine(program)
+    assert(m.run("a") == (True, 1)); assert(m.run("b") == (True, 1))
+    assert(m.run("x") == (False, None))
+
+    # Unknown rules are always tried, so they aren't skipped silently
+    g = Parser("A <- 'a' / B / 'c'").parse()
+    a = Analyzer(g)
+    [_, b, _] = a.g['A'].value
+    assert(b in a.dispatch(a.g['A']).candidates('x'))
+    assert(b in a.dispatch(a.g['A']).candidates(None))
+    for data in ["x", ""]:
+        raised = False
+        try: Eval(g, 'A', data).run()
+        except KeyError: raised = True
+        assert(raised)
+
+    # The analysis of a grammar can be shared by its engines
+    e, f = Eval(g, 'A', "a", analyzer=a), Eval(g, 'A', "a", analyzer=a)
+    e.run(); f.run()
+    assert(e.analyzer is a and f.analyzer is a)
+    assert(ClosureCompiler(g, analyzer=a).analyzer is a)
+    assert(Compiler(g, analyzer=a).analyzer is a)
+    e = Eval(g, 'A', "a")
+    e.run()
+    assert(e.analyzer is not a)
+
+
+def test_grammar_cache():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'csv.g')
+        with io.open(path, 'w') as f: f.write(csv)
+
+        cache = GrammarCache(path)
+        assert(not cache.hit)
+        assert(cache.grammar() == Parser(csv).parse())
+        assert(os.listdir(os.path.join(directory, '__pegcache__')) == ['csv.g.pickle'])
+        program = cache.bytecode('CSV')
+        assert(program == Compiler(Parser(csv).parse(), 'CSV').run())
+
+        cache = GrammarCache(path)
+        assert(cache.hit)
+        assert(cache.grammar() == Parser(csv).parse())
+        assert(cache.analysis is None)
+        assert(cache.analyzer() is cache.analyzer())
+        assert(cache.analyzer().nullables['Val'])
+        assert(cache.entry['bytecode'] == {'CSV': program})
+        assert(Machine(cache.bytecode('CSV')).run("a,b\n") == (True, 4))
+
+        # Changing the grammar invalidates its entry
+        with io.open(path, 'w') as f: f.write(arith)
+        cache = GrammarCache(path)
+        assert(not cache.hit)
+        assert(cache.grammar() == Parser(arith).parse())
+        assert(GrammarCache(path).hit)
+
+        # Broken cache files and disabled caches parse the grammar again
+        with io.open(cache.path, 'wb') as f: f.write(b'garbage')
+        assert(not GrammarCache(path).hit)
+        assert(not GrammarCache(path, enabled=False).hit)
+
+        # Entries others can write to aren't trusted
+        cache = GrammarCache(path)
+        assert(GrammarCache(path).hit)
+        os.chmod(cache.path, 0o666)
+        assert(not GrammarCache(path).hit)
+        os.chmod(cache.path, 0o644)
+        os.chmod(os.path.dirname(cache.path), 0o777)
+        assert(not GrammarCache(path).hit)
+        os.chmod(os.path.dirname(cache.path), 0o755)
+        assert(GrammarCache(path).hit)
+
+        # Entries of another version of the engine are ignored
+        entry = dict(cache.entry, digest=hashlib.sha256(cache.source).hexdigest())
+        with io.open(cache.path, 'wb') as f: pickle.dump(entry, f)
+        assert(not GrammarCache(path).hit)
+
+        # Entries that can't be written don't leave temporary files
+        cache.entry['bytecode'][None] = lambda: None
+        cache.write()
+        assert(os.listdir(os.path.dirname(cache.path)) == ['csv.g.pickle'])
+
+        # Grammars that fail the checks aren't cached
+        with io.open(path, 'w') as f: f.write("A <- A 'a'")
+        raised = False
+        try: GrammarCache(path)
+        except Exception: raised = True
+        assert(raised)
+
+
+def test_profile():
+    g = Parser(arith).parse()
+    profile = Profile(g)
+    assert(Eval(g, 'Add', "1+2*3", profile=profile).run() == Eval(g, 'Add', "1+2*3").run())
+    add, num = profile.rules['Add'], profile.rules['Num']
+    # Add <- Mul '+' Add / Mul is called once from the top and once
+    # after the '+'.  The second call tries its first alternative,
+    # which fails after the whole `2*3' matched, and falls back to Mul
+    assert((add['calls'], add['successes'], add['failures']) == (2, 2, 0))
+    assert(add['consumed'] == 5 + 3)
+    assert(profile.alternatives['Add/1'] == {'tried': 2, 'rejected': 1})
+    assert(profile.alternatives['Add/2'] == {'tried': 1, 'rejected': 0})
+    assert(num['failures'] == 0 and num['successes'] == num['calls'])
+    assert(add['total'] >= add['own'] >= 0)
+    assert(not any(profile.active.values()))
+
+    # Same numbers from the closures
+    closures = Profile(g)
+    assert(ClosureCompiler(g, closures).run('Add', "1+2*3") == Eval(g, 'Add', "1+2*3").run())
+    for name in profile.rules:
+        for key in ['calls', 'successes', 'failures', 'consumed']:
+            assert(closures.rules[name][key] == profile.rules[name][key])
+    assert(closures.alternatives == profile.alternatives)
+
+    # Nested choices get numbered within their rule
+    p = Profile(Parser("A <- 'a' ('b' / 'c') / 'd'").parse())
+    assert(sorted(p.labels.values()) == ['A#2/1', 'A#2/2', 'A/1', 'A/2'])
+
+    out = io.StringIO()
+    profile.report(out)
+    lines = out.getvalue().splitlines()
+    assert(lines[0].split() == ['calls', 'ok', 'failed', 'consumed', 'own', 'total', 'rule'])
+    assert(sorted(l.split()[-1] for l in lines[1:5]) == ['Add', 'Mul', 'Num', 'Pri'])
+    assert('Add/1' in out.getvalue())
+
+
+def test_spans():
+    g = Parser(csv).parse()
+    data = "Name,Num\nçã,,x\n"
+    e = Eval(g, 'File', data, spans=True)
+    match, value = e.run()
+    assert((match, value) == (True, [
+        [(0, 4), [[(4, 5), (5, 8)]], (8, 9)],
+        [(9, 11), [(11, 12), [(12, 13), (13, 14)]], (14, 15)]]))
+    assert(e.pos == len(data))
+    # Repetitions of text like Val are joined
+    assert(materialize(value, data) == [
+        ['Name', [[',', 'Num']], '\n'], ['çã', [',', [',', 'x']], '\n']])
+
+    g = Parser(arith).parse()
+    value = Eval(g, 'Add', "(1+2)*30+4", spans=True).run()[1]
+    assert(materialize(value, "(1+2)*30+4") == [[['(', ['1', '+', '2'], ')'], '*', '30'], '+', '4'])
+    assert(Eval(g, 'Add', "12+3", spans=True).run() == (True, [(0, 2), (2, 3), (3, 4)]))
+    assert(Eval(g, 'Add', "+", spans=True).run() == (False, None))
+
+    # Everything else has the same shape it has without spans
+    g = Parser("S <- 'ab' !'c' . [x-z]? ('1' '2')* / 'a'").parse()
+    for data in ["abdz1212", "abd", "a"]:
+        expected = Eval(g, 'S', data).run()
+        match, value = Eval(g, 'S', data, spans=True).run()
+        assert(match == expected[0]); assert(materialize(value, data) == expected[1])
+    assert(materialize([None, (1, 3), ['x']], "abcd") == [None, 'bc', ['x']])
+
+    # A Plus matches when its first iteration does, even if it matched
+    # nothing.  Repeating a nullable body never ends, so the Star after
+    # the first iteration is cut short
+    g = Parser("S <- ('a'?)+ 'b'").parse()
+    for data in ["b", "ab"]:
+        expected = Eval(g, 'S', data)
+        e = Eval(g, 'S', data, spans=True)
+        expected.evalStar = e.evalStar = lambda atom: (True, [])
+        expected = expected.run()
+        match, value = e.run()
+        assert(match == expected[0]); assert(materialize(value, data) == expected[1])
+
+    # Spans keep pointing at the right place in a stream
+    data = "a,b\n" * 50
+    g = Parser(csv).parse()
+    stream = Stream(io.StringIO(data), chunkSize=8)
+    e = Eval(g, 'File', stream, spans=True)
+    for i, row in enumerate(e.iterate()):
+        assert(row[0] == (i * 4, i * 4 + 1))
+        assert(materialize(row, stream) == ['a', [[',', 'b']], '\n'])
+
+
+
+def test_tree():
+    g = Parser(csv).parse()
+    data = "Name,Num\nçã,,x\n"
+    value = Eval(g, 'File', data, spans=True).run()[1]
+    t = Tree(data)
+    assert(t.add(value) == 0)
+    assert(t.value(0) == value)
+    assert(t.span(0) == (0, len(data)))
+    [row1, row2] = t.children(0)
+    assert(t.value(row2) == value[1]); assert(t.text(row2) == "çã,,x\n")
+    assert([t.text(c) for c in t.children(row1)] == ['Name', ',Num', '\n'])
+    assert(all(t.parents[c] == row1 for c in t.children(row1)))
+    assert(list(t.children()) == [0])
+
+    # Records are added as roots, and None and empty lists are kept
+    t = Tree(data)
+    t.extend(Eval(g, 'File', data, spans=True).iterate())
+    assert([t.value(i) for i in t.children()] == value)
+    t = Tree()
+    t.add([None, [], [(0, 1)]])
+    assert(t.value(0) == [None, [], [(0, 1)]])
+    assert(t.span(0) == (0, 1)); assert(t.span(2) is None)
+
+    # Deep trees don't use the Python stack
+    value = [(0, 1)]
+    for i in range(1, 5000): value = [(0, 1), value, (i, i + 1)]
+    t = Tree()
+    t.add(value)
+    assert(len(t) == 3 * 4999 + 2)
+    rebuilt, depth = t.value(0), 0
+    while len(rebuilt) == 3:
+        assert(rebuilt[2] == (4999 - depth, 5000 - depth))
+        rebuilt, depth = rebuilt[1], depth + 1
+    assert(rebuilt == [(0, 1)] and depth == 4999)
+
+    raised = False
+    try: Tree().add(['text'])
+    except TypeError: raised = True
+    assert(raised)
+
+
+def test_actions():
+    g = Parser(arith).parse()
+    calc = {
+        'Add': lambda text, values: sum(values),
+        'Mul': lambda text, values: functools.reduce(lambda a, b: a * b, values),
+        'Num': lambda text, values: int(text),
+    }
+    for data, expected in [("1", 1), ("(1+2)*3+4", 13), ("2*(3+4)*5", 70)]:
+        assert(Eval(g, 'Add', data, actions=calc).run() == (True, expected))
+        assert(Eval(g, 'Add', data, actions=calc, packrat=True).run() == (True, expected))
+        assert(Eval(g, 'Add', data, actions=calc, profile=Profile(g)).run() == (True, expected))
+    assert(Eval(g, 'Add', "+", actions=calc).run() == (False, None))
+    # Rules without actions pass the results of the ones they call up
+    assert(Eval(g, 'Pri', "(1+2)", actions=calc).run() == (True, [3]))
+    assert(Eval(g, 'Add', "1+2", actions={'Num': calc['Num']}).run() == (True, [1, 2]))
+
+    # Without any action the input is only recognized
+    e = Eval(g, 'Add', "(1+2)*3", actions={})
+    assert(e.run() == (True, [])); assert(e.pos == 7); assert(e.values == [])
+
+    # Results of alternatives and predicates that failed are dropped
+    g = Parser("S <- !(A 'z') A 'x' / A 'y'\nA <- 'a'").parse()
+    calls = []
+    def a(text, values):
+        calls.append(text)
+        return len(calls)
+    assert(Eval(g, 'S', "ay", actions={'A': a}).run() == (True, [3]))
+    assert(calls == ['a'] * 3)
+
+    # Records of a stream are handed out one at a time
+    g = Parser(csv).parse()
+    stream = Stream(io.StringIO("a,b\nc\n" * 100), chunkSize=8)
+    rows = Eval(g, 'File', stream, actions={'Val': lambda text, values: text,
+                                           'CSV': lambda text, values: values}).iterate()
+    assert(next(rows) == ['a', 'b']); assert(next(rows) == ['c'])
+    assert(len(list(rows)) == 198)
+
+
+def test_incremental():
+    g = Parser(csv).parse()
+    data = ''.join("f%d,%d\n" % (i, i * 7) for i in range(100))
+    e = Eval(g, 'File', data, incremental=True)
+    assert(e.run() == Eval(g, 'File', data).run())
+
+    # Count the rules that run again instead of coming from the memo
+    misses = []
+    rule = e.memoRule
+    def counter(atom):
+        misses.append(atom.value)
+        return rule(atom)
+    e.memoRule = counter
+
+    for offset, removed, inserted in [
+            (data.index("f50,"), 3, "changed"),  # Inside of a row
+            (data.index("f10,"), 0, "new,row\n"),  # A whole new row
+            (data.index("f90,"), len("f90,630\n"), ""),  # Removes a row
+            (0, 0, "x"), (len(e.data), 0, "last\n")]:
+        del misses[:]
+        e.edit(offset, removed, inserted)
+        data = data[:offset] + inserted + data[offset + removed:]
+        assert(e.data == data)
+        assert(e.run() == Eval(g, 'File', data).run())
+        # The start rule, the rows around the edit and their values
+        assert(len(misses) < 12)
+        assert(misses.count('CSV') <= 2)
+
+    # Edits that break the input are recovered from too
+    e = Eval(Parser(arith).parse(), 'Add', "1+2*3", incremental=True)
+    assert(e.run() == (True, ['1', '+', ['2', '*', '3']]))
+    e.edit(2, 1, "(")
+    assert(e.run() == (True, '1'))
+    e.edit(2, 1, "(4+5)")
+    assert(e.run() == Eval(Parser(arith).parse(), 'Add', "1+(4+5)*3").run())
+
+    # Entries that start in the removed chars are dropped, even the
+    # ones that didn't look at any char
+    g = Parser("S <- A 'b' B?\nA <- 'a'\nB <- ''").parse()
+    e = Eval(g, 'S', "abc", incremental=True)
+    assert(e.run() == (True, ['a', 'b']))
+    assert(e.memo[2]['B'][3] == 0)
+    e.edit(2, 1, "")
+    assert(2 not in e.memo)
+    assert(e.run() == (True, ['a', 'b']))
+
+    # Changing the output doesn't change the memo
+    e = Eval(Parser(csv).parse(), 'File', "a,b\n", incremental=True)
+    output = e.run()
+    output[1][0].append('x')
+    e.edit(4, 0, "")
+    assert(e.run() == Eval(Parser(csv).parse(), 'File', "a,b\n").run())
+
+
+def test_stream():
+    data = "Name,Num,Lang\nLink,3,pt-br\nçã,4,x\n" * 20
+    g = Parser(csv).parse()
+    expected = Eval(g, 'File', data).run()
+
+    e = Eval(g, 'File', Stream(io.StringIO(data), chunkSize=7))
+    assert(e.run() == expected); assert(e.pos == len(data))
+    # Only the last row was still in the buffer
+    assert(len(e.data.buffer) < 40)
+    raised = False
+    try: e.data[0]
+    except Exception: raised = True
+    assert(raised)
+
+    # Bytes are decoded, even when a char is split between chunks
+    e = Eval(g, 'File', Stream(io.BytesIO(data.encode('utf-8')), chunkSize=5))
+    assert(e.run() == expected)
+    assert(ClosureCompiler(g).run('File', Stream(io.BytesIO(data.encode('utf-8')), chunkSize=5)) == expected)
+
+    # Rules that aren't repetitions just read the stream
+    e = Eval(Parser(arith).parse(), 'Add', Stream(io.StringIO("12+34*56"), chunkSize=2))
+    assert(e.run() == (True, [['1', '2'], '+', [['3', '4'], '*', ['5', '6']]]))
+    assert(ClosureCompiler(g).run('CSV', Stream(io.StringIO("a,b\n"))) == (True, [['a'], [[',', ['b']]], '\n']))
+    assert(ClosureCompiler(g).run('CSV', Stream(io.StringIO("a,b"))) == (False, None))
+
+    # The machines take mmap objects directly
+    with tempfile.TemporaryFile() as f:
+        f.write(data.encode('latin-1')); f.flush()
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        program = Compiler(g).run()
+        assert(Machine(program).match(m) == len(data))
+        assert(CMachine(program).match(m) == len(data))
+        m.close()
+
+    # Mapped files must be ASCII to match the same as decoded ones
+    with tempfile.TemporaryFile() as f:
+        f.write(b"a,b\n"); f.flush()
+        m = mapFile(f)
+        assert(Machine(Compiler(g).run()).match(m) == 4)
+        m.close()
+        f.write(u"\u00e9\n".encode('utf-8')); f.flush()
+        raised = False
+        try: mapFile(f)
+        except Exception as e: raised = str(e) == "Non ASCII byte at 4, run without --stream"
+        assert(raised)
+
+    # Empty files are empty input
+    with tempfile.TemporaryFile() as f:
+        m = mapFile(f)
+        assert(m == b'')
+        program = Compiler(g).run()
+        assert(Machine(program).run(m) == (True, 0))
+        assert(CMachine(program).run(m) == (True, 0))
+
+    # The body of the repetition is compiled once
+    c = ClosureCompiler(g)
+    list(c.iterate('File', data)); body = c.bodies['File']
+    list(c.iterate('File', data))
+    assert(c.bodies['File'] is body)
+
+
+def test_iterate():
+    g = Parser(csv).parse()
+    data = "a,b\nc\n"
+    rows = Eval(g, 'File', data).run()[1]
+
+    e = Eval(g, 'File', data)
+    records = e.iterate()
+    assert(next(records) == rows[0]); assert(e.pos == 4)
+    assert(next(records) == rows[1]); assert(e.pos == 6)
+    assert(list(records) == [])
+    assert(list(Eval(g, 'File', data + "d").iterate()) == rows)
+    assert(list(Eval(g, 'File', "").iterate()) == [])
+
+    c = ClosureCompiler(g)
+    assert([i for i, _ in c.iterate('File', data)] == [4, 6])
+    assert(list(c.iterate('File', data, 4)) == [c.match('CSV', data, 4)])
+
+    # Rows are released from the stream as they're yielded
+    stream = Stream(io.StringIO(data * 1000), chunkSize=16)
+    count = 0
+    for value in Eval(g, 'File', stream).iterate():
+        assert(value == rows[count % 2]); count += 1
+        assert(len(stream.buffer) < 40)
+    assert(count == 2000)
+    stream = Stream(io.StringIO(data * 1000), chunkSize=16)
+    assert(sum(1 for _ in c.iterate('File', stream)) == 2000)
+
+    # The memo only keeps what the next records may use
+    e = Eval(g, 'File', data * 1000, packrat=True)
+    for value in e.iterate():
+        assert(all(pos >= e.pos for pos in e.memo))
+    assert(e.pos == len(data) * 1000 and e.memoSize < 20)
+
+    raised = False
+    try: next(Eval(g, 'CSV', data).iterate())
+    except Exception: raised = True
+    assert(raised)
+
+
+def test_parallel():
+    g = Parser(csv).parse()
+    data = "Name,Num\nLink,3\n" * 50
+    assert(splitRecords("a\nb\nc", 1) == ["a\n", "b\n", "c"])
+    assert(splitRecords("a\nb\nc", 3) == ["a\nb\n", "c"])
+    assert(splitRecords("", 3) == [])
+    assert(''.join(splitRecords(data, 10)) == data)
+
+    expected = Eval(g, 'File', data).run()
+    assert(parallel(g, 'File', data, workers=2, chunkSize=40) == expected)
+    assert(parallel(g, 'File', data, workers=2) == expected)
+
+    # Errors are reported with the line within the whole input
+    g = Parser("File <- Row*\nRow <- [A-Za-z]+ ',' [A-Za-z0-9]+ '\\n'").parse()
+    lines = data.splitlines(True)
+    lines[62] = lines[90] = "broken\n"
+    message = None
+    try: parallel(g, 'File', ''.join(lines), workers=2, chunkSize=40)
+    except SyntaxError as exc: message = str(exc)
+    assert(message == "Failed to match File at line 63")
+    assert(parallel(g, 'File', data, workers=2, chunkSize=40) == Eval(g, 'File', data).run())
+
+
+def test_packrat():
+    g = Parser(arith).parse()
+    data = '(' * 6 + '1+2' + ')' * 6 + '*3'
+    plain = Eval(g, 'Add', data)
+    expected = plain.run()
+    memo = Eval(g, 'Add', data, packrat=True)
+    assert(memo.run() == expected); assert(memo.pos == plain.pos)
+
+    # Every rule is evaluated at most once per position
+    assert(memo.memoSize <= len(g) * (len(data) + 1))
+
+    # Same results with a tiny table that keeps getting evicted
+    small = Eval(g, 'Add', data, packrat=True, memoLimit=8)
+    assert(small.run() == expected); assert(small.pos == plain.pos)
+    assert(small.memoSize <= 8)
+
+    e = Eval(Parser(csv).parse(), 'File', "a,b\nc\n", packrat=True)
+    assert(e.run() == (True, [[['a'], [[',', ['b']]], '\n'], [['c'], '\n']]))
+
+
+def test_closures():
+    for g, start, data in [
+        ('Lit <- "test"', 'Lit', "testando"),
+        ('Lit <- "test"', 'Lit', "lata"),
+        ('Digit <- [0-9]', 'Digit', "42f"),
+        ('Digit <- [0-9]+', 'Digit', "42f"),
+        ('Digit <- [0-9]+', 'Digit', "f42"),
+        ('Digit <- [0-9]*', 'Digit', "2048f"),
+        ('Digit <- [0-9]*', 'Digit', "2048"),
+        ('AtoC <- [a-c]\\nNoAtoC <- !AtoC .', 'NoAtoC', 'abc'),
+        ('AtoC <- [a-c]\\nNoAtoC <- !AtoC .', 'NoAtoC', 'def'),
+        ('AtoC <- [a-c]\\nAtoCNext <- &AtoC .', 'AtoCNext', 'cd'),
+        ('AtoC <- [a-c]\\nAtoCNext <- &AtoC .', 'AtoCNext', 'dc'),
+        ('EOF <- !.', 'EOF', ''),
+        ('EOF <- !.', 'EOF', 'f'),
+        ('R0 <- "oi" "tenta"?', 'R0', 'oitenta'),
+        ('R0 <- "oi" "tenta"?', 'R0', 'oi'),
+        (arith, 'Add', "12+34*56"),
+        (arith, 'Add', "(1+2)*3"),
+        (csv, 'File', "Name,Num,Lang\nLink,3,pt-br\n"),
+        ("EndOfLine <- '\r\n' / '\n' / '\r'", 'EndOfLine', "\n\r\n\r"),
+        ("EndOfLine <- '\r\n' / '\n' / '\r'", 'EndOfLine', "\r\n"),
+    ]:
+        grammar = Parser(g).parse()
+        e = Eval(grammar, start, data)
+        expected = e.evalAtom(Identifier(start))
+        assert(ClosureCompiler(grammar).run(start, data) == expected)
+        if expected[0]:
+            assert(ClosureCompiler(grammar).match(start, data)[0] == e.pos)
+
+    # Compiled once, used with many inputs
+    cc = ClosureCompiler(Parser(arith).parse())
+    assert(cc.run('Add', "1+2") == (True, ['1', '+', '2']))
+    assert(cc.run('Add', "3") == (True, '3'))
+    assert(cc.run('Add', "+") == (False, None))
+    assert(cc.match('Num', "a42", 1) == (3, ['4', '2']))
+
+
 def test_compiler():
     compiler = Compiler(Parser("S <- 'a'").run())
     # No arguments
@@ -894,7 +2966,7 @@ def test_compiler():
 
 
 def test_compile():
-    cc = lambda code: Compiler(Parser(code).run()).run()
+    cc = lambda code: Compiler(Parser(code).run(), optimize=False).run()
     bn = lambda *bc: struct.pack('B' * len(bc), *bc)
 
     # Char 'c'
@@ -941,34 +3013,312 @@ def test_compile():
         0xd0, 0x0, 0x0, 0x00,   # 0xa: Return
         0x00, 0x0, 0x0, 0x00,   # 0xb: Halt
     ))
-    return
+
     # Concatenation
     assert(cc("S <- 'a' . 'c'") == bn(
         0xc0, 0x0, 0x0, 0x02,   # 0x1: Call 0x2 [0x3]
-        0xb0, 0x0, 0x0, 0x05,   # 0x2: Jump 0x5
-
-        0x10, 0x0, 0x0, 0x61,   # Char 'a'
-        0x20, 0x0, 0x0, 0x00,   # Any
-        0x10, 0x0, 0x0, 0x63,   # Char 'c'
-        0x00, 0x0, 0x0, 0x00,   # Halt
+        0xb0, 0x0, 0x0, 0x06,   # 0x2: Jump 0x6
+        0x10, 0x0, 0x0, 0x61,   # 0x3: Char 'a'
+        0x20, 0x0, 0x0, 0x00,   # 0x4: Any
+        0x10, 0x0, 0x0, 0x63,   # 0x5: Char 'c'
+        0xd0, 0x0, 0x0, 0x00,   # 0x6: Return
+        0x00, 0x0, 0x0, 0x00,   # 0x7: Halt
     ))
 
     # Ordered Choice
     assert(cc("S <- 'a' / 'b'") == bn(
-        0x30, 0x0, 0x0, 0x03,   # Choice 0x03
-        0x10, 0x0, 0x0, 0x61,   # Char 'a'
-        0x40, 0x0, 0x0, 0x03,   # Commit 0x03
-        0x10, 0x0, 0x0, 0x62,   # Char 'b'
-        0x00, 0x0, 0x0, 0x00,   # Halt
+        0xc0, 0x0, 0x0, 0x02,   # 0x1: Call 0x2 [0x3]
+        0xb0, 0x0, 0x0, 0x07,   # 0x2: Jump 0x7
+        0x30, 0x0, 0x0, 0x03,   # 0x3: Choice 0x03 [0x6]
+        0x10, 0x0, 0x0, 0x61,   # 0x4: Char 'a'
+        0x40, 0x0, 0x0, 0x02,   # 0x5: Commit 0x02 [0x7]
+        0x10, 0x0, 0x0, 0x62,   # 0x6: Char 'b'
+        0xd0, 0x0, 0x0, 0x00,   # 0x7: Return
+        0x00, 0x0, 0x0, 0x00,   # 0x8: Halt
+    ))
+
+    # Classes are ordered choices of chars
+    assert(cc("S <- [ab]") == cc("S <- 'a' / 'b'"))
+    assert(cc("S <- [a-b]") == cc("S <- 'a' / 'b'"))
+
+    # Star
+    assert(cc("S <- 'a'*") == bn(
+        0xc0, 0x0, 0x0, 0x02,   # 0x1: Call 0x2 [0x3]
+        0xb0, 0x0, 0x0, 0x06,   # 0x2: Jump 0x6
+        0x30, 0x0, 0x0, 0x03,   # 0x3: Choice 0x03 [0x6]
+        0x10, 0x0, 0x0, 0x61,   # 0x4: Char 'a'
+        0x7f, 0xff, 0xff, 0xff, # 0x5: PartialCommit -1 [0x4]
+        0xd0, 0x0, 0x0, 0x00,   # 0x6: Return
+        0x00, 0x0, 0x0, 0x00,   # 0x7: Halt
+    ))
+
+    # Plus
+    assert(cc("S <- 'a'+") == bn(
+        0xc0, 0x0, 0x0, 0x02,   # 0x1: Call 0x2 [0x3]
+        0xb0, 0x0, 0x0, 0x07,   # 0x2: Jump 0x7
+        0x10, 0x0, 0x0, 0x61,   # 0x3: Char 'a'
+        0x30, 0x0, 0x0, 0x03,   # 0x4: Choice 0x03 [0x7]
+        0x10, 0x0, 0x0, 0x61,   # 0x5: Char 'a'
+        0x7f, 0xff, 0xff, 0xff, # 0x6: PartialCommit -1 [0x5]
+        0xd0, 0x0, 0x0, 0x00,   # 0x7: Return
+        0x00, 0x0, 0x0, 0x00,   # 0x8: Halt
+    ))
+
+    # Question
+    assert(cc("S <- 'a'?") == bn(
+        0xc0, 0x0, 0x0, 0x02,   # 0x1: Call 0x2 [0x3]
+        0xb0, 0x0, 0x0, 0x06,   # 0x2: Jump 0x6
+        0x30, 0x0, 0x0, 0x03,   # 0x3: Choice 0x03 [0x6]
+        0x10, 0x0, 0x0, 0x61,   # 0x4: Char 'a'
+        0x40, 0x0, 0x0, 0x01,   # 0x5: Commit 1 [0x6]
+        0xd0, 0x0, 0x0, 0x00,   # 0x6: Return
+        0x00, 0x0, 0x0, 0x00,   # 0x7: Halt
+    ))
+
+    # Identifier
+    assert(cc("S <- D '+' D\nD <- '0' / '1'") == bn(
+        0xc0, 0x0, 0x0, 0x02,   # 0x1: Call 0x2 [0x3]
+        0xb0, 0x0, 0x0, 0x0b,   # 0x2: Jump 0xb
+        0xc0, 0x0, 0x0, 0x04,   # 0x3: Call 0x4 [0x7]
+        0x10, 0x0, 0x0, 0x2b,   # 0x4: Char '+'
+        0xc0, 0x0, 0x0, 0x02,   # 0x5: Call 0x2 [0x7]
+        0xd0, 0x0, 0x0, 0x00,   # 0x6: Return
+        0x30, 0x0, 0x0, 0x03,   # 0x7: Choice 0x03 [0xa]
+        0x10, 0x0, 0x0, 0x30,   # 0x8: Char '0'
+        0x40, 0x0, 0x0, 0x02,   # 0x9: Commit 0x02 [0xb]
+        0x10, 0x0, 0x0, 0x31,   # 0xa: Char '1'
+        0xd0, 0x0, 0x0, 0x00,   # 0xb: Return
+        0x00, 0x0, 0x0, 0x00,   # 0xc: Halt
+    ))
+
+    # Calls can go backwards too
+    compiler = Compiler(Parser("S <- 'a' S?").run())
+    compiler.run()
+    assert(compiler.rules == {'S': 2})
+    assert(compiler.code[4] == compiler.gen(Instructions.OP_CALL, -2))
+
+    # Every grammar that the parser accepts can be compiled
+    for g in [csv, arith, open(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), 'peg.g')).read()]:
+        cc(g)
+
+def test_compile_optimized():
+    cc = lambda code: Compiler(Parser(code).run()).run()
+    bn = lambda *bc: struct.pack('B' * len(bc), *bc)
+    digits = (0x0, 0x0, 0x0, 0x0, 0x03, 0xff, 0x0, 0x0) + (0x0,) * 24
+
+    # Guarded ordered choice
+    assert(cc("S <- 'a' / 'b'") == bn(
+        0xc0, 0x0, 0x0, 0x02,   # 0x1: Call 0x2 [0x3]
+        0xb0, 0x0, 0x0, 0x08,   # 0x2: Jump 0x8
+        0x90, 0x1, 0x0, 0x61,   # 0x3: TestChar 0x04 'a' [0x7]
+        0x30, 0x0, 0x0, 0x03,   # 0x4: Choice 0x03 [0x7]
+        0x10, 0x0, 0x0, 0x61,   # 0x5: Char 'a'
+        0x40, 0x0, 0x0, 0x02,   # 0x6: Commit 0x02 [0x8]
+        0x10, 0x0, 0x0, 0x62,   # 0x7: Char 'b'
+        0xd0, 0x0, 0x0, 0x00,   # 0x8: Return
+        0x00, 0x0, 0x0, 0x00,   # 0x9: Halt
     ))
 
+    # Classes are sets
+    assert(cc("S <- [0-9]") == bn(
+        0xc0, 0x0, 0x0, 0x02,   # 0x1: Call 0x2 [0x3]
+        0xb0, 0x0, 0x0, 0x0c,   # 0x2: Jump 0xc
+        0xe0, 0x0, 0x0, 0x00,   # 0x3: Set [0-9]
+        *digits,                # 0x4-0xb: 256 bits
+        0xd0, 0x0, 0x0, 0x00,   # 0xc: Return
+        0x00, 0x0, 0x0, 0x00,   # 0xd: Halt
+    ))
+    assert(cc("S <- [0123456789]") == cc("S <- [0-9]"))
+
+    # Repeated sets are spans
+    assert(cc("S <- [0-9]*") == bn(
+        0xc0, 0x0, 0x0, 0x02,   # 0x1: Call 0x2 [0x3]
+        0xb0, 0x0, 0x0, 0x0c,   # 0x2: Jump 0xc
+        0xf0, 0x0, 0x0, 0x00,   # 0x3: Span [0-9]
+        *digits,                # 0x4-0xb: 256 bits
+        0xd0, 0x0, 0x0, 0x00,   # 0xc: Return
+        0x00, 0x0, 0x0, 0x00,   # 0xd: Halt
+    ))
+
+    # End of file
+    assert(cc("S <- !.") == bn(
+        0xc0, 0x0, 0x0, 0x02,   # 0x1: Call 0x2 [0x3]
+        0xb0, 0x0, 0x0, 0x05,   # 0x2: Jump 0x5
+        0xa0, 0x0, 0x80, 0x01,  # 0x3: TestAny 0x02 1 [0x5]
+        0x50, 0x0, 0x0, 0x00,   # 0x4: Fail
+        0xd0, 0x0, 0x0, 0x00,   # 0x5: Return
+        0x00, 0x0, 0x0, 0x00,   # 0x6: Halt
+    ))
+
+    # Chars out of the set fall back to ordered choices
+    assert(Machine(cc("S <- [a-ā]")).match("ā") == 1)
+    assert(Machine(cc("S <- [a-ā]")).match("`") is None)
+
+    # Same matches with and without optimizations
+    pegg = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'peg.g')).read()
+    for g, data in [
+        (arith, "12+34*56"),
+        (arith, "(1+2)*3+"),
+        (csv, "Name,Num,Lang\nLink,3,pt-br\n"),
+        ("S <- [a-c]+ 'x'? !.", "abcx"),
+        ("S <- [a-c]+ 'x'? !.", "abcxd"),
+        ("S <- 'ab' / 'ac' / 'a' / .", "ac"),
+        ("S <- 'ab' / 'ac' / 'a' / .", "ad"),
+        ("S <- 'ab' / 'ac' / 'a' / .", "da"),
+        (pegg, pegg),
+    ]:
+        grammar = Parser(g).run()
+        plain = Compiler(grammar, optimize=False).run()
+        optimized = Compiler(grammar).run()
+        assert(Machine(optimized).match(data) == Machine(plain).match(data))
+        assert(CMachine(optimized).match(data) == Machine(plain).match(data))
+
+
+def test_machine():
+    run = lambda g, data: Machine(Compiler(Parser(g).run()).run()).match(data)
+
+    # Same programs used by the tests in vm.c
+    assert(Machine(bytes([0x10, 0, 0, 0x61, 0, 0, 0, 0])).match("a") == 1)
+    assert(Machine(bytes([0x10, 0, 0, 0x61, 0, 0, 0, 0])).match("x") is None)
+    assert(Machine(bytes([0x20, 0, 0, 0, 0, 0, 0, 0])).match("") is None)
+    assert(Machine(bytes([0x30, 0, 0, 0x03,
+                          0x10, 0, 0, 0x61,
+                          0x60, 0, 0, 0,
+                          0, 0, 0, 0])).match("b") == 0)
+    assert(Machine(bytes([0x30, 0, 0, 0x03,
+                          0x10, 0, 0, 0x61,
+                          0x80, 0, 0, 0x01,
+                          0, 0, 0, 0])).match("a") == 0)
+
+    assert(run("S <- 'a' . 'c'", "abc") == 3)
+    assert(run("S <- 'a' . 'c'", "abd") is None)
+    assert(run("S <- 'a' / 'b'", "b") == 1)
+    assert(run("S <- 'a' / 'b'", "c") is None)
+    assert(run("S <- [a-c]+ 'x'?", "abcxd") == 4)
+    assert(run("S <- [a-c]+ 'x'?", "abcd") == 3)
+    assert(run("S <- [a-c]+ 'x'?", "d") is None)
+    assert(run("S <- &'a' .", "ab") == 1)
+    assert(run("S <- !'a' .", "ab") is None)
+    assert(run("S <- !'a' .", "ba") == 1)
+    assert(run(arith, "12+34*56") == 8)
+    assert(run(arith, "(1+2)*3+") == 7)
+    assert(run(arith, "+") is None)
+    assert(run(csv, "Name,Num,Lang\nLink,3,pt-br\n") == 27)
+    assert(run(csv, b"Name,Num,Lang\nLink,3,pt-br\n") == 27)
+    assert(run("S <- 'ç'+", "çça") == 2)
+
+    # Deep nesting doesn't touch Python's stack
+    data = '(' * 5000 + 'x' + ')' * 5000
+    assert(run("S <- '(' S ')' / 'x'", data) == len(data))
+
+    # Can start from other rules than the first one
+    m = Machine(Compiler(Parser(arith).run(), 'Num').run())
+    assert(m.run("12+3") == (True, 2))
+    assert(m.run("+3") == (False, None))
+
+    # Choices guarded by TestChar are skipped without backtracking.
+    # Backtracks are only counted when profiling
+    g = Parser("S <- 'a' / 'b'").run()
+    m = Machine(Compiler(g, optimize=False).run(), profile=True)
+    assert(m.run("b") == (True, 1)); assert(m.backtracks == 1)
+    m = Machine(Compiler(g, optimize=False).run())
+    assert(m.run("b") == (True, 1)); assert(m.backtracks == 0)
+    m = Machine(Compiler(g).run(), profile=True)
+    assert(m.run("b") == (True, 1)); assert(m.backtracks == 0)
+    e = Eval(g, 'S', "b", profile=Profile(g))
+    assert(e.run() == (True, 'b')); assert(e.backtracks == 0)
+    g = Parser("S <- 'a' 'b' / 'a' 'c'").run()
+    e = Eval(g, 'S', "ac", profile=Profile(g))
+    assert(e.run() == (True, ['a', 'c'])); assert(e.backtracks == 1)
+    e = Eval(g, 'S', "ac")
+    assert(e.run() == (True, ['a', 'c'])); assert(e.backtracks == 0)
+    g = Parser("S <- !'x' 'a'? 'b'* 'c'+").run()
+    for spans in [False, True]:
+        e = Eval(g, 'S', "ccd", profile=Profile(g), spans=spans)
+        assert(e.run()[0]); assert(e.backtracks == 4)
+    e = Eval(g, 'S', "ccd", profile=Profile(g), actions={})
+    assert(e.run()[0]); assert(e.backtracks == 4)
+
+
+def test_cmachine():
+    for g, data in [
+        ("S <- 'a' . 'c'", "abc"),
+        ("S <- 'a' . 'c'", "abd"),
+        ("S <- [a-c]+ 'x'?", "abcxd"),
+        ("S <- [a-c]+ 'x'?", "d"),
+        ("S <- !'a' .", "ba"),
+        ("S <- 'a'", ""),
+        (arith, "12+34*56"),
+        (arith, "(1+2)*3+"),
+        (csv, "Name,Num,Lang\nLink,3,pt-br\n"),
+    ]:
+        program = Compiler(Parser(g).run()).run()
+        expected = Machine(program).match(data)
+        m = CMachine(program)
+        assert(m.match(data) == expected)
+        assert(m.match(data.encode()) == expected)
+        assert(m.match(bytearray(data.encode())) == expected)
+        assert(m.match(memoryview(data.encode())) == expected)
+
+    # The program is loaded once and matched against many inputs
+    m = CMachine(Compiler(Parser(csv).run(), 'CSV').run())
+    assert([m.match(r) for r in [b"a,b\n", b"a", b"\n"]] == [4, None, 1])
+    assert(m.match(b"xx\nyyy\n", 3) == 7)
+
+    # The stack grows past its initial size instead of exiting
+    data = '(' * 1000 + '1' + ')' * 1000
+    m = CMachine(Compiler(Parser("S <- '(' S ')' / [0-9]").run()).run())
+    assert(m.match(data) == len(data))
+
+    # Code points above 0xff
+    program = Compiler(Parser("S <- 'a€' [€-₿]* 'ç' .").run()).run()
+    for data in ["a€₿€çx", "a€çx", "a€ç", "aç"]:
+        assert(CMachine(program).match(data) == Machine(program).match(data))
+        assert(CMachine(program).match('x' + data, 1) == Machine(program).match('x' + data, 1))
+
+    # Errors of the machine are raised
+    try: CMachine(struct.pack('>I', Instructions.OP_RETURN.value << 28)).match("a")
+    except Exception as exc: assert(str(exc) == 'Stack underflow')
+    else: assert(False)
+
+    # Positions must be within the input
+    m = CMachine(Compiler(Parser("S <- 'a'*").run()).run())
+    assert(m.match("aaa", 3) == 3)
+    for pos in [4, 7, -1]:
+        for data in ["aaa", "aa€"]:
+            raised = False
+            try: m.match(data, pos)
+            except ValueError: raised = True
+            assert(raised)
+
+
 def test():
     test_tokenizer()
     test_parser()
+    test_parser_deep()
     # test_parse_errors()
     test_eval()
+    test_charset()
+    test_slots()
+    test_analyzer()
+    test_dispatch()
+    test_grammar_cache()
+    test_profile()
+    test_spans()
+    test_tree()
+    test_actions()
+    test_incremental()
+    test_stream()
+    test_iterate()
+    test_parallel()
+    test_packrat()
+    test_closures()
     test_compiler()
     test_compile()
+    test_compile_optimized()
+    test_machine()
+    test_cmachine()
 
 
 def main():
@@ -986,19 +3336,82 @@ def main():
     parser.add_argument(
         '-s', '--start', dest='start', action='store',
         help='Start rule. Which rule the parser should start at.')
+    parser.add_argument(
+        '-e', '--engine', dest='engine', action='store', default='eval',
+        choices=['eval', 'closures', 'vm', 'cvm'],
+        help='Which engine should run the grammar. Defaults to `eval\'')
+    parser.add_argument(
+        '-p', '--packrat', dest='packrat', action='store_true', default=False,
+        help='Memoize rule results (linear time, more memory)')
+    parser.add_argument(
+        '--memo-limit', dest='memoLimit', action='store', type=int,
+        help='Maximum number of entries kept in the packrat memo table')
+    parser.add_argument(
+        '--stream', dest='stream', action='store_true', default=False,
+        help='Read the data file in chunks (or mmap it for the vm engines)')
+    parser.add_argument(
+        '-r', '--records', dest='records', action='store_true', default=False,
+        help='Print each match of the start rule as soon as it is parsed '
+        '(eval and closures)')
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs', action='store', type=int,
+        help='Split line oriented data and parse it with this many processes')
+    parser.add_argument(
+        '--spans', dest='spans', action='store_true', default=False,
+        help='Output (start, end) spans instead of text (eval)')
+    parser.add_argument(
+        '--profile', dest='profile', action='store_true', default=False,
+        help='Print the time spent in each rule to stderr (eval and closures)')
+    parser.add_argument(
+        '--no-cache', dest='cache', action='store_false', default=True,
+        help='Don\'t read or write the grammar cache in __pegcache__')
     args = parser.parse_args()
-    with io.open(os.path.abspath(args.grammar), 'r') as grammarFile:
-        grammar = Parser(grammarFile.read()).run()
-
-    # if args.compile:
-    #     name, _ = os.path.splitext(args.grammar)
-    #     with io.open('%s.bin' % name, 'wb') as out:
-    #         compiled = Compiler(grammar).run()
-    #         out.write(compiled)
-    # else:
-    with io.open(os.path.abspath(args.data), 'r') as dataFile:
-        output = Eval(grammar, args.start, dataFile.read()).run()
-        pprint.pprint(output)
+    if args.records and args.engine in ('vm', 'cvm'):
+        parser.error('--records works with the eval and closures engines')
+    cache = GrammarCache(os.path.abspath(args.grammar), enabled=args.cache)
+    grammar = cache.grammar()
+    profile = Profile(grammar) if args.profile else None
+
+    if args.compile:
+        name, _ = os.path.splitext(args.grammar)
+        with io.open('%s.bin' % name, 'wb') as out:
+            out.write(cache.bytecode(args.start))
+        return
+
+    with io.open(os.path.abspath(args.data), 'rb') as dataFile:
+        if args.jobs:
+            data = dataFile.read().decode('utf-8')
+        elif args.stream and args.engine in ('vm', 'cvm'):
+            data = mapFile(dataFile)
+        elif args.stream:
+            data = Stream(dataFile)
+        else:
+            data = dataFile.read().decode('utf-8')
+
+        if args.jobs:
+            output = parallel(grammar, args.start, data, workers=args.jobs)
+        elif args.records and args.engine == 'closures':
+            for _, value in ClosureCompiler(grammar, profile, cache.analyzer()).iterate(args.start, data):
+                pprint.pprint(value)
+            output = None
+        elif args.records:
+            for value in Eval(grammar, args.start, data, packrat=args.packrat,
+                              memoLimit=args.memoLimit, profile=profile,
+                              spans=args.spans, analyzer=cache.analyzer()).iterate():
+                pprint.pprint(value)
+            output = None
+        elif args.engine == 'closures':
+            output = ClosureCompiler(grammar, profile, cache.analyzer()).run(args.start, data)
+        elif args.engine == 'vm':
+            output = Machine(cache.bytecode(args.start)).run(data)
+        elif args.engine == 'cvm':
+            output = CMachine(cache.bytecode(args.start)).run(data)
+        else:
+            output = Eval(grammar, args.start, data, packrat=args.packrat,
+                          memoLimit=args.memoLimit, profile=profile,
+                          spans=args.spans, analyzer=cache.analyzer()).run()
+        if output is not None: pprint.pprint(output)
+        if profile is not None: profile.report(sys.stderr)
 
 if __name__ == '__main__':
     # test()
@@ -65,13 +65,13 @@ Machine Instructions
 * [x] FailTwice l
 * [x] PartialCommit
 * [x] BackCommit l
-* [ ] TestChar l o
-* [ ] TestAny n o
+* [x] TestChar l o
+* [x] TestAny n o
 * [x] Jump l
 * [x] Call l
 * [x] Return
-* [ ] Set
-* [ ] Span
+* [x] Set
+* [x] Span
 
 Bytecode Format
 ===============
@@ -121,6 +121,13 @@ Instruction with 2 parameters (Eg.: TestChar 4 97)
     * u1operand() Read first operand as unsigned values
     * s2operand() Read second operand as signed value
     * u2operand() Read second operand as unsigned value
+
+Sets
+----
+
+`Set' and `Span' take no parameters. They're followed by 8 words that
+form a 256 bit set. Bit `c % 32' of the word `c / 32' is set when the
+char `c' is in the set. The instruction after the set is at pc + 9.
 */
 
 /* Instruction Offsets - All sizes are in bits */
@@ -139,6 +146,9 @@ Instruction with 2 parameters (Eg.: TestChar 4 97)
 
 #define S2_OPERAND_SIZE  14
 
+/* Number of 32bit words in the set that follows Set & Span */
+#define SET_SIZE 8
+
 /** Clear all 28bits from the right then shift to the right */
 #define OP_MASK(c) (((c) & 0xff000000) >> OPERATOR_OFFSET)
 
@@ -148,9 +158,19 @@ Instruction with 2 parameters (Eg.: TestChar 4 97)
 #define SIGNED(i,s) ((int32_t) ((i & (1 << (s - 1))) ? (i | ~((1 << s) - 1)) : i))
 /** Read single operand from instruction */
 #define SOPERAND0(op) SIGNED (op->rand, S_OPERAND_SIZE)
+/** Read the first of two operands as a signed value */
+#define S1OPERAND(op) SIGNED (((op->rand >> S2_OPERAND_SIZE) & 0x3fff), S1_OPERAND_SIZE)
+/** Read the second of two operands as an unsigned value */
+#define U2OPERAND(op) (op->rand & 0x3fff)
+/** Put the whole 32bit word back together (used by sets) */
+#define WORD(op) (((uint32_t) (op)->rator << OPERATOR_OFFSET) | (op)->rand)
+/** Test if char `c' is within the set that starts at `set' */
+#define INSET(set,c) ((c) < 256 && ((WORD ((set) + ((c) >> 5)) >> ((c) & 31)) & 1))
 
 /* Arbitrary values */
 
+/* Initial number of entries of the backtrack stack, it doubles each
+   time it gets full */
 #define STACK_SIZE 512
 
 /* -- Error control & report utilities -- */
@@ -178,6 +198,8 @@ typedef enum {
   OP_JUMP,
   OP_CALL,
   OP_RETURN,
+  OP_SET,
+  OP_SPAN,
   OP_END,
 } Instructions;
 
@@ -201,8 +223,14 @@ typedef struct {
 typedef struct {
   const char *s;
   size_t s_size;
+  /* Bytes per char of the input, either 1 or 4 */
+  unsigned width;
   Instruction *code;
-  BacktrackEntry stack[STACK_SIZE];
+  BacktrackEntry *stack;
+  size_t stack_size;
+  /* Why the last call to mEval() or mRead() failed, if it did */
+  const char *error;
+  char message[64];
 } Machine;
 
 /* Helps debugging */
@@ -220,32 +248,92 @@ static const char *opNames[OP_END] = {
   [OP_JUMP] = "OP_JUMP",
   [OP_CALL] = "OP_CALL",
   [OP_RETURN] = "OP_RETURN",
+  [OP_SET] = "OP_SET",
+  [OP_SPAN] = "OP_SPAN",
 };
 
+/* Point the machine to a new input. The code loaded with mRead() is
+   kept, so the same program can be matched against many inputs.  The
+   size is in bytes.  With a width of 4, each char of the input is a
+   code point in native byte order (UTF-32) */
+void mInput (Machine *m, const char *input, size_t input_size, unsigned width)
+{
+  m->s = input;
+  m->s_size = input_size;
+  m->width = width;
+}
+
 /* Set initial values for the machine */
 void mInit (Machine *m, const char *input, size_t input_size)
 {
-  memset (m->stack, 0, STACK_SIZE * sizeof (void *));
   m->code = NULL;               /* Will be set by mRead() */
-  m->s = input;
-  m->s_size = input_size;
+  m->stack = NULL;              /* Allocated by mEval() */
+  m->stack_size = 0;
+  m->error = NULL;
+  mInput (m, input, input_size, 1);
+}
+
+/* Error of the last call to mEval() or mRead(), NULL if it worked */
+const char *mError (Machine *m)
+{
+  return m->error;
+}
+
+/* Size of the machine, for callers that allocate it themselves */
+size_t mSizeOf (void)
+{
+  return sizeof (Machine);
 }
 
 void mFree (Machine *m)
 {
   free (m->code);
+  free (m->stack);
   m->code = NULL;
+  m->stack = NULL;
+  m->stack_size = 0;
+}
+
+/* Double the size of the backtrack stack that has `used' entries in
+   use. Returns where the next entry goes, or NULL if there's no memory
+   left */
+static BacktrackEntry *mGrow (Machine *m, size_t used)
+{
+  size_t size = m->stack_size ? m->stack_size * 2 : STACK_SIZE;
+  BacktrackEntry *stack;
+
+  if (size < m->stack_size ||
+      (stack = malloc (size * sizeof (BacktrackEntry))) == NULL)
+    return NULL;
+  if (m->stack) memcpy (stack, m->stack, used * sizeof (BacktrackEntry));
+  free (m->stack);
+  m->stack = stack;
+  m->stack_size = size;
+  return stack + used;
+}
+
+/* Read the char under the cursor `i' */
+static inline uint32_t mChar (const Machine *m, const char *i)
+{
+  uint32_t c;
+  if (m->width == 1) return (uint8_t) *i;
+  memcpy (&c, i, sizeof (c));
+  return c;
 }
 
 void mRead (Machine *m, Bytecode *code, size_t code_size)
 {
   Instruction *tmp;
   uint32_t instr;
+  size_t n;
 
-  /* Code size is in uint8_t and each instruction is 16bits */
-  if ((tmp = m->code = calloc (sizeof (Instruction), code_size / 4 + 2)) == NULL)
-    FATAL ("Can't allocate %s", "memory");
-  while (*code) {
+  /* Code size is in uint8_t and each instruction is 32bits */
+  m->error = NULL;
+  if ((tmp = m->code = calloc (sizeof (Instruction), code_size / 4 + 2)) == NULL) {
+    m->error = "Can't allocate memory";
+    return;
+  }
+  for (n = code_size / 4; n > 0; n--) {
     instr  = *code++ << 24;
     instr |= *code++ << 16;
     instr |= *code++ << 8;
@@ -258,15 +346,34 @@ void mRead (Machine *m, Bytecode *code, size_t code_size)
   }
 }
 
-/* Run the matching machine */
+/* Run the matching machine.  Returns NULL when the input doesn't
+   match and also when the machine can't go on, in which case
+   mError() tells why */
 const char *mEval (Machine *m)
 {
   BacktrackEntry *sp = m->stack;
   Instruction *pc = m->code;
   const char *i = m->s;
-
-  /** Push data onto the machine's stack  */
-#define PUSH(ii,pp) do { sp->i = ii; sp->pc = pp; sp++; } while (0)
+  const size_t w = m->width;
+
+  m->error = NULL;
+
+  /** Push data onto the machine's stack, growing it when it's full */
+#define PUSH(ii,pp) do {                                              \
+    if (sp >= m->stack + m->stack_size) {                              \
+      size_t used = sp - m->stack;                                      \
+      if ((sp = mGrow (m, used)) == NULL) {                             \
+        m->error = "Stack overflow";                                    \
+        return NULL;                                                    \
+      }                                                                 \
+    }                                                                   \
+    sp->i = ii; sp->pc = pp; sp++;                                      \
+  } while (0)
+  /** Bail when an instruction needs an entry and the stack has none,
+      which only happens with broken bytecode */
+#define UNDERFLOW() do {                                              \
+    if (sp == m->stack) { m->error = "Stack underflow"; return NULL; }  \
+  } while (0)
   /** Pop data from the machine's stack. Notice it doesn't dereference
       the pointer, callers are supposed to do that when needed. */
 #define POP() (--sp)
@@ -285,14 +392,34 @@ const char *mEval (Machine *m)
     case OP_CHAR:
       DEBUG ("       OP_CHAR: `%c' == `%c' ? %d", *i,
              UOPERAND (pc), *i == UOPERAND (pc));
-      if (*i == UOPERAND (pc)) { i++; pc++; }
+      if (i < THE_END && mChar (m, i) == UOPERAND (pc)) { i += w; pc++; }
       else goto fail;
       continue;
     case OP_ANY:
       DEBUG ("       OP_ANY: `%c' < |s| ? %d", *i, i < THE_END);
-      if (i < THE_END) { i++; pc++; }
+      if (i < THE_END) { i += w; pc++; }
+      else goto fail;
+      continue;
+    case OP_SET:
+      DEBUG ("       OP_SET: `%c'", *i);
+      if (i < THE_END && INSET (pc + 1, mChar (m, i))) { i += w; pc += SET_SIZE + 1; }
       else goto fail;
       continue;
+    case OP_SPAN:
+      DEBUG ("       OP_SPAN: `%c'", *i);
+      while (i < THE_END && INSET (pc + 1, mChar (m, i))) i += w;
+      pc += SET_SIZE + 1;
+      continue;
+    case OP_TEST_CHAR:
+      DEBUG ("       OP_TEST_CHAR: `%c' == `%c'", *i, U2OPERAND (pc));
+      if (i < THE_END && mChar (m, i) == U2OPERAND (pc)) pc++;
+      else pc += S1OPERAND (pc);
+      continue;
+    case OP_TEST_ANY:
+      DEBUG ("       OP_TEST_ANY: %ld >= %d", THE_END - i, U2OPERAND (pc));
+      if ((size_t) (THE_END - i) / w >= U2OPERAND (pc)) pc++;
+      else pc += S1OPERAND (pc);
+      continue;
     case OP_CHOICE:
       DEBUG ("       OP_CHOICE: `%p'", i);
       PUSH (i, pc + UOPERAND (pc));
@@ -300,18 +427,18 @@ const char *mEval (Machine *m)
       continue;
     case OP_COMMIT:
       DEBUG ("       OP_COMMIT: `%p'", i);
-      assert (sp > m->stack);
+      UNDERFLOW ();
       POP ();                   /* Discard backtrack entry */
       pc += SOPERAND0 (pc);     /* Jump to the given position */
       continue;
     case OP_PARTIAL_COMMIT:
-      assert (sp > m->stack);
+      UNDERFLOW ();
       DEBUG ("       OP_PARTIAL_COMMIT: %s", i);
       pc += SOPERAND0 (pc);
       (sp - 1)->i = i;
       continue;
     case OP_BACK_COMMIT:
-      assert (sp > m->stack);
+      UNDERFLOW ();
       DEBUG ("       OP_BACK_COMMIT: %s", i);
       i = POP ()->i;
       pc += SOPERAND0 (pc);
@@ -324,10 +451,11 @@ const char *mEval (Machine *m)
       pc += SOPERAND0 (pc);
       continue;
     case OP_RETURN:
-      assert (sp > m->stack);
+      UNDERFLOW ();
       pc = POP ()->pc;
       continue;
     case OP_FAIL_TWICE:
+      UNDERFLOW ();
       POP ();                   /* Drop top of stack & Fall through */
     case OP_FAIL:
     fail:
@@ -345,11 +473,15 @@ const char *mEval (Machine *m)
       }
       continue;
     default:
-      FATAL ("Unknown Instruction 0x%04x [%s]", pc->rator, OP_NAME (pc->rator));
+      snprintf (m->message, sizeof (m->message), "Unknown Instruction 0x%04x [%s]",
+                pc->rator, OP_NAME (pc->rator));
+      m->error = m->message;
+      return NULL;
     }
   }
 
 #undef PUSH
+#undef UNDERFLOW
 #undef POP
 #undef THE_END
 }
@@ -390,12 +522,13 @@ int run (const char *grammar_file, const char *input_file)
 
   mInit (&m, input, input_size);
   mRead (&m, grammar, grammar_size);
-  mEval (&m);
+  if (!mError (&m)) mEval (&m);
+  if (mError (&m)) fprintf (stderr, "%s\n", mError (&m));
   mFree (&m);
 
   free (grammar);
   free (input);
-  return EXIT_SUCCESS;
+  return mError (&m) ? EXIT_FAILURE : EXIT_SUCCESS;
 }
 
 /* Print out instructions on to how to use the program */
@@ -414,7 +547,12 @@ void usage (const char *program, const char *msg)
 #define MATCH_OPT(short_desc,long_desc) \
   (argc > 0) && (strcmp (*args, short_desc) == 0 || strcmp (*args, long_desc) == 0)
 
-#ifndef TEST
+#if defined (LIBRARY)
+
+/* Built as a shared library to be driven from peg.py. See `CMachine'
+   over there and the `libvm.so' target in the Makefile */
+
+#elif !defined (TEST)
 
 /* Temporary main function */
 int main (int argc, char **argv)
@@ -567,7 +705,7 @@ void test_not1 ()
   const char *o;
   DEBUG (" * t:not.1 %s", "");
 
-  mInit (&m, "b", 0);
+  mInit (&m, "b", 1);
   mRead (&m, b, 20);
   o = mEval (&m);
   mFree (&m);
@@ -589,7 +727,7 @@ void test_not1_fail_twice ()
   const char *o;
   printf (" * t:not.1 fail-twice\n");
 
-  mInit (&m, "b", 0);
+  mInit (&m, "b", 1);
   mRead (&m, b, 16);
   o = mEval (&m);
   mFree (&m);
@@ -616,7 +754,7 @@ void test_not2 ()
   };
   DEBUG (" * t:not.2 %s", "");
 
-  mInit (&m, "a", 0);
+  mInit (&m, "a", 1);
   mRead (&m, b, 20);
   assert (!mEval (&m));         /* Failed */
   mFree (&m);
@@ -634,7 +772,7 @@ void test_not2_fail_twice ()
   };
   DEBUG (" * t:not.2 fail-twice %s", "");
 
-  mInit (&m, "a", 0);
+  mInit (&m, "a", 1);
   mRead (&m, b, 16);
   assert (!mEval (&m));         /* Failed */
   mFree (&m);
@@ -714,7 +852,7 @@ void test_and2 ()
   };
   DEBUG (" * t:and.%s", "2");
 
-  mInit (&m, "b", 0);
+  mInit (&m, "b", 1);
   mRead (&m, b, 32);
   assert (!mEval (&m));         /* Failed */
   mFree (&m);
@@ -914,7 +1052,7 @@ void test_rep1 ()
   const char *o;
   DEBUG (" * t:rep.1 %s", "");
 
-  mInit (&m, "aab", 1);
+  mInit (&m, "aab", 3);
   mRead (&m, b, 16);
   o = mEval (&m);
   mFree (&m);
@@ -936,7 +1074,7 @@ void test_rep1_partial_commit ()
   const char *o;
   DEBUG (" * t:rep.1 %s", "(partial-commit)");
 
-  mInit (&m, "aab", 1);
+  mInit (&m, "aab", 3);
   mRead (&m, b, 16);
   o = mEval (&m);
   mFree (&m);
@@ -1068,6 +1206,129 @@ void test_var2 ()
   mFree (&m);
 }
 
+/* [0-9] */
+static const Bytecode digits[32] = {
+  0x00, 0x0, 0x0, 0x00,       /* chars 0x00-0x1f */
+  0x03, 0xff, 0x0, 0x00,      /* chars 0x20-0x3f: '0'..'9' */
+  0x00, 0x0, 0x0, 0x00,
+  0x00, 0x0, 0x0, 0x00,
+  0x00, 0x0, 0x0, 0x00,
+  0x00, 0x0, 0x0, 0x00,
+  0x00, 0x0, 0x0, 0x00,
+  0x00, 0x0, 0x0, 0x00,
+};
+
+void test_set ()
+{
+  Machine m;
+  /* [0-9] */
+  Bytecode b[44] = { 0xe0, 0x0, 0x0, 0x00 }; /* Set [0-9] */
+  const char *o;
+  DEBUG (" * t:set %s", "");
+  memcpy (b + 4, digits, 32);   /* Halt is the zeroed tail */
+
+  mInit (&m, "4a", 2);
+  mRead (&m, b, 40);
+  o = mEval (&m);
+  assert (o);                   /* Didn't fail */
+  assert (o - m.s == 1);        /* Matched one digit */
+  mInput (&m, "a4", 2, 1);
+  assert (!mEval (&m));         /* Failed */
+  mFree (&m);
+}
+
+void test_span ()
+{
+  Machine m;
+  /* [0-9]* */
+  Bytecode b[44] = { 0xf0, 0x0, 0x0, 0x00 }; /* Span [0-9] */
+  const char *o;
+  DEBUG (" * t:span %s", "");
+  memcpy (b + 4, digits, 32);   /* Halt is the zeroed tail */
+
+  mInit (&m, "2048a", 5);
+  mRead (&m, b, 40);
+  o = mEval (&m);
+  assert (o);                   /* Didn't fail */
+  assert (o - m.s == 4);        /* Matched all the digits */
+  mInput (&m, "a", 1, 1);
+  o = mEval (&m);
+  assert (o);                   /* Span never fails */
+  assert (o - m.s == 0);        /* But didn't match anything */
+  mFree (&m);
+}
+
+void test_test_char ()
+{
+  Machine m;
+  /* 'a' / 'b' */
+  Bytecode b[28] = {
+    0x90, 0x01, 0x00, 0x61,     /* TestChar 0x04 'a' */
+    0x30, 0x0, 0x0, 0x03,       /* Choice 0x03 */
+    0x10, 0x0, 0x0, 0x61,       /* Char 'a' */
+    0x40, 0x0, 0x0, 0x02,       /* Commit 0x02 */
+    0x10, 0x0, 0x0, 0x62,       /* Char 'b' */
+    0x00, 0x0, 0x0, 0x00,       /* Halt */
+  };
+  const char *o;
+  DEBUG (" * t:test-char %s", "");
+
+  mInit (&m, "b", 1);
+  mRead (&m, b, 24);
+  o = mEval (&m);
+  assert (o);                   /* Didn't fail */
+  assert (o - m.s == 1);        /* Skipped straight to 'b' */
+  mInput (&m, "a", 1, 1);
+  o = mEval (&m);
+  assert (o);                   /* Didn't fail */
+  assert (o - m.s == 1);        /* Matched 'a' */
+  mInput (&m, "c", 1, 1);
+  assert (!mEval (&m));         /* Failed */
+  mFree (&m);
+
+  /* Without a choice to fall back to, 'b' only matches if TestChar
+     jumps over Char 'a' */
+  Bytecode jump[20] = {
+    0x90, 0x0, 0xc0, 0x61,      /* TestChar 0x03 'a' */
+    0x10, 0x0, 0x0, 0x61,       /* Char 'a' */
+    0x00, 0x0, 0x0, 0x00,       /* Halt */
+    0x10, 0x0, 0x0, 0x62,       /* Char 'b' */
+    0x00, 0x0, 0x0, 0x00,       /* Halt */
+  };
+  mInit (&m, "b", 1);
+  mRead (&m, jump, 20);
+  o = mEval (&m);
+  assert (o);                   /* Jumped to Char 'b' */
+  assert (o - m.s == 1);
+  mInput (&m, "a", 1, 1);
+  o = mEval (&m);
+  assert (o);                   /* Fell through to Char 'a' */
+  assert (o - m.s == 1);
+  mFree (&m);
+}
+
+void test_test_any ()
+{
+  Machine m;
+  /* !. */
+  Bytecode b[12] = {
+    0xa0, 0x0, 0x80, 0x01,      /* TestAny 0x02 1 */
+    0x50, 0x0, 0x0, 0x00,       /* Fail */
+    0x00, 0x0, 0x0, 0x00,       /* Halt */
+  };
+  const char *o;
+  DEBUG (" * t:test-any %s", "");
+
+  mInit (&m, "", 0);
+  mRead (&m, b, 12);
+  o = mEval (&m);
+  assert (o);                   /* Didn't fail */
+  assert (o - m.s == 0);        /* At the end of the input */
+  mInput (&m, "a", 1, 1);
+  assert (!mEval (&m));         /* Failed */
+  mFree (&m);
+}
+
 int main ()
 {
   test_ch1 ();
@@ -1094,7 +1355,11 @@ int main ()
   test_rep2_partial_commit ();
   test_var1 ();
   test_var2 ();
+  test_set ();
+  test_span ();
+  test_test_char ();
+  test_test_any ();
   return 0;
 }
 
-#endif  /* TEST */
+#endif  /* LIBRARY, TEST */